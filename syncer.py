@@ -5,10 +5,18 @@
 """
   syncer track <repo-name>      # Track the current dir with the given repo name (a name may be, e.g., a github url).
   syncer track <file1> <file2>  # Track the given file pair.
+  syncer track <file1> ... <fileN>  # Track a group of files that must all match.
   syncer check                  # Check current repo for any incoming out outgoing file changes.
   syncer check --all            # Check all known repo-name/dir and file/file pairs for differences.
+  syncer check <path> ...       # Check only the connections of the given files; "-" reads paths from stdin.
+  syncer check --paths-from-git [--staged] --report  # Check files changed in git, as in a pre-commit hook.
+  syncer check --budget <ms>    # Check the most recently changed files first, stopping after <ms> ms.
   syncer remind                 # Print all paths affected by last run of "syncer check"; useful for testing.
   syncer list                   # Print all file pairs checked for equality.
+  syncer list [--rescan] [--format tsv|json]  # As above, with each file's role and sync state.
+  syncer plan [<plan-file>]     # Save every copy needed to sync the current repo (or --all) as a plan.
+  syncer apply [<plan-file>]    # Run a saved plan in parallel; on any failure, all changes are undone.
+  syncer find-duplicates        # Print "syncer track" lines for untracked copies of files across repos.
 """
 #
 # Metadata is stored in human-friendly files in the directory ~/.syncer
@@ -21,14 +29,24 @@
 
 import difflib
 import fcntl
-import filecmp
+import atexit
+import hashlib
+import heapq
+import itertools
+import json
 from optparse import OptionParser
 import os
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 import pprint
 import re
+import shlex
 import shutil
+import stat
+import subprocess
 import sys
+import tempfile
+import time
 
 
 # globals
@@ -51,6 +69,17 @@ _pairs_header = 'file-file pairs'
 # _pairs = [[path1, path2]]
 _pairs = []
 
+# The string used in .syncer to denote groups of files that must all match, apart from line 3.
+_groups_header = 'file groups'
+
+# _groups = [[path1, path2, ..., pathN]]
+_groups = []
+
+# For acting on a divergent group. Each file shown in a group difference maps to the other members
+# of the group that match it, apart from line 3; a copy to that file is also made to each of them.
+# {path: [other_paths]}
+_group_mates = {}
+
 # For accumulating differences.
 # {home_path: set((copy_path, ignore_line3))}
 _diffs_by_home_path = {}
@@ -74,6 +103,15 @@ _diff_header = '\nvvvvvvv %20s vvvvvvv'
 _diff_footer = '\n^^^^^^^ %20s ^^^^^^^'
 #                 1234567      1234567
 
+# The number of terminal rows, used to size pages of the difference summary.
+_term_rows = 24
+
+# With more differing files than this, the summary is shown as pages of groups by repo and dir.
+_max_ungrouped_diffs = 9
+
+# The number of difference rows shown for each group in the grouped summary.
+_rows_per_group = 3
+
 # The string used in .syncer to denote recently changed paths (_changed_paths).
 _changed_paths_header = 'recently changed paths'
 
@@ -82,9 +120,44 @@ _changed_paths_header = 'recently changed paths'
 _changed_paths = {}
 
 # Header and dictionary to track cached info.
-# _cached_info_by_path[path] = {home_info: [home_repo, home_subdir], times: (mtime, ctime)}
+# _cached_info_by_dir[dir_path][basename] = (home_repo, home_subdir, fingerprint, seen, digest)
+# Paths are split into a shared directory key plus a basename so that a directory's path string is
+# stored once rather than once per file. home_repo and home_subdir are interned strings (or None),
+# fingerprint is the (mtime_ns, ctime_ns, size, inode) tuple from _stat_fingerprint, seen is the
+# start time, in ns, of the last run that saw the file, and digest is the hex digest of the file's
+# contents, or None if it hasn't been computed. An entry is only used while its fingerprint matches.
 _cached_info_header = 'cached info (home_repo, home_subdir, file times)'
-_cached_info_by_path = {}
+_cached_info_by_dir = {}
+
+# Entries seen during this run have their seen value set to _run_time. A full scan drops any entry
+# it didn't see, and saving evicts the least recently seen entries beyond _max_cached_info_entries.
+_run_time = time.time_ns()
+_max_cached_info_entries = 500000
+
+# Header for ~/.syncer/pair_index, which lets "syncer list" answer without walking the repos. Each
+# full walk in _find_repo_file_pairs saves the index; see _save_pair_index. An index is fresh while
+# every walked dir keeps its mtime and the stat fingerprints of its files, and the repos and copy
+# dirs are unchanged; see _dir_files_digest and _pair_index_config_digest. Paths are JSON strings,
+# so that any path can be read back.
+_pair_index_header = ('pair index (config digest, then dir mtimes and file digests, then [home, '
+                      'copy] JSON pairs)')
+
+# Header for ~/.syncer/dir_recency, which ranks the dirs of cached files by their newest cached
+# mtime so that a budgeted check can start scanning without ranking the whole cache; see
+# _save_dir_recency. The number of cached files is saved, too, to report what a check left out.
+_dir_recency_header = 'dirs by recency (number of cached files, then dirs, newest first)'
+
+# Counters reported by the --stats option; see _show_stats.
+_stats = {'header cache hits': 0, 'header cache misses': 0,
+          'file stats requested': 0, 'file stats made': 0}
+
+# A run-scoped cache of os.stat results for files that may be compared; see _stat.
+# _stat_by_path[path] = <os.stat_result, or None if the path couldn't be stat'ed>
+_stat_by_path = {}
+
+# This is set by 'syncer check --report', which prints each difference as soon as it's found.
+_do_report = False
+_num_reported_diffs = 0
 
 # This is used by the 'syncer check' command to indicate when we're filtering to a local repo, and
 # to indicate the path of that local repo.
@@ -98,6 +171,13 @@ _local_repo_path   = None
 _copy_dirs = {}
 _copy_dirs_header = 'copied directories (home name -> copy path [-> copy info])'
 
+# Path tries indexing _copy_dirs; see _trie_add. These are kept up to date by _add_copy_dir.
+# _copy_infos_by_home_dir[home_name] = <trie of copy_info['home_path'] -> copy_info>
+# _copy_infos_by_copy_dir[home_name] = <trie of copy_info['copy_path'] -> copy_info>
+# Each copy_info also has an 'excluded_index' trie of its excluded set.
+_copy_infos_by_home_dir = {}
+_copy_infos_by_copy_dir = {}
+
 # This is a map from (here_path, gone_path) to the relevant copy_info.
 _gone_file_metadata = {}
 
@@ -108,9 +188,11 @@ _unknown_home_path = '(unknown home path)'
 # ===================
 
 def _init():
-  global _horiz_break, _diff_header, _diff_footer
-  rows, columns = os.popen('stty size', 'r').read().split()
-  pad_len = min(int(columns) - len(_horiz_break) - 2, 100)  # 100 is the max separator width.
+  global _horiz_break, _diff_header, _diff_footer, _term_rows
+  # This falls back to a default size when syncer isn't run from a terminal, as in a git hook.
+  columns, rows = shutil.get_terminal_size()
+  _term_rows = rows
+  pad_len = min(columns - len(_horiz_break) - 2, 100)  # 100 is the max separator width.
   if pad_len <= 0: return
   _horiz_break += '-' * pad_len
   _diff_header += 'v' * pad_len
@@ -121,7 +203,34 @@ def _handle_args(args):
   parser = OptionParser(usage=__doc__)
   parser.add_option('--all', action='store_true', dest='do_check_all', default=False,
                     help='for check action, globally checks all tracked files')
+  parser.add_option('--cache-size', type='int', dest='cache_size',
+                    default=_max_cached_info_entries,
+                    help='maximum number of files kept in ~/.syncer/cached_info')
+  parser.add_option('--stats', action='store_true', dest='show_stats', default=False,
+                    help='print cache and file system statistics before exiting')
+  parser.add_option('--paths-from-git', action='store_true', dest='paths_from_git',
+                    default=False,
+                    help='for check action, only checks files listed by "git diff --name-only"')
+  parser.add_option('--staged', action='store_true', dest='staged', default=False,
+                    help='with --paths-from-git, uses staged changes ("git diff --cached")')
+  parser.add_option('--budget', type='int', dest='budget', default=None,
+                    help='for check action, checks the most recently changed files first and '
+                         'stops after this many milliseconds')
+  parser.add_option('--rescan', action='store_true', dest='do_rescan', default=False,
+                    help='for list action, walks all repos instead of using ~/.syncer/pair_index')
+  parser.add_option('--format', type='choice', choices=['plain', 'tsv', 'json'],
+                    dest='list_format', default='plain',
+                    help='for list action, one of plain, tsv or json; tsv and json include each '
+                         "file's role and whether the files are in sync")
+  parser.add_option('--report', action='store_true', dest='do_report', default=False,
+                    help='for check action, prints differences without prompting; exits with '
+                         'status 1 if any are found')
   (options, args) = parser.parse_args(args)
+  _set_cache_size(options.cache_size)
+  if options.budget is not None and options.budget <= 0:
+    print('Error: --budget must be positive.')
+    exit(2)
+  if options.show_stats: atexit.register(_show_stats)
   if len(args) <= 1:
     parser.print_help()
     exit(2)
@@ -137,7 +246,16 @@ def _handle_args(args):
     _remind(args[2:])
   elif action == 'list':
     _load_config()
-    _list(args[2:])
+    _list(args[2:], options)
+  elif action == 'plan':
+    _load_config()
+    _plan(args[2:], options)
+  elif action == 'apply':
+    _load_config()
+    _apply(args[2:])
+  elif action == 'find-duplicates':
+    _load_config()
+    _find_duplicates(args[2:])
   else:
     print('Unrecognized action: %s.' % action)
     parser.print_help()
@@ -148,9 +266,9 @@ def _handle_args(args):
 # ========================
 
 def _track(action_args):
-  global _repos, _pairs
-  if len(action_args) < 1 or len(action_args) > 2:
-    print('Expected one or two parameters as items to track.')
+  global _repos, _pairs, _groups
+  if len(action_args) < 1:
+    print('Expected a repo name or file paths as items to track.')
     exit(2)
   if len(action_args) == 1:  # Track a repo/path pair.
     # Make sure the repo name is new.
@@ -161,38 +279,61 @@ def _track(action_args):
       exit(1)
     _repos.append([action_args[0], os.getcwd()])
     print('Started tracking the repo and dir:\n%s\n%s' % tuple(_repos[-1]))
-  if len(action_args) == 2:  # Track a file/file pair.
+  if len(action_args) >= 2:  # Track a file/file pair or a file group.
     for path in action_args:
-      if not os.path.isfile(path):
+      if not _isfile(path):
         print('Error: %s is not a file.' % path)
         exit(1)
     # Make sure we have absolute paths saved.
     paths = [os.path.abspath(path) for path in action_args]
-    if os.path.basename(paths[0]) != os.path.basename(paths[1]):
+    if len(set([os.path.basename(path) for path in paths])) > 1:
+      print('Error: file names must match to track them together.')
+      exit(1)
+    group = _find_group(paths)
+    if group is None and len(paths) == 2:
+      _pairs.append(paths)
+      print('Started tracking the files:\n%s\n%s' % tuple(_pairs[-1]))
+      return
+    if group is None:
+      group = []
+      _groups.append(group)
+    new_paths = [path for path in paths if path not in group]
+    if group and os.path.basename(group[0]) != os.path.basename(paths[0]):
       print('Error: file names must match to track them together.')
       exit(1)
-    _pairs.append(paths)
-    print('Started tracking the files:\n%s\n%s' % tuple(_pairs[-1]))
+    group.extend(new_paths)
+    print('Started tracking the files as a group of %d:' % len(group))
+    for path in new_paths: print(path)
 
 def _check(action_args, options):
   global _repos, _pairs, _changed_paths, _do_use_local_repo
-  if len(action_args) > 0:
-    print('Unexpected arguments after "check": %s' % ' '.join(action_args))
-    exit(2)
-  _setup_local_repo_globals(options)
-  print('Checking for differences.')
-  repo_file_pairs = _find_repo_file_pairs()
-  for home_file_path, copy_path in repo_file_pairs:
-    _compare_full_paths(home_file_path, copy_path)
-  for path1, path2 in _pairs:
-    _compare_full_paths(path1, path2, ignore_line3=True)
+  global _do_report
+  # A check of given paths never walks the repos, even if the list of paths turns out empty.
+  paths_given = bool(action_args) or options.paths_from_git
+  if action_args == ['-']:
+    # Reading paths from stdin implies --report, since stdin can't also answer prompts.
+    options.do_report = True
+    action_args = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+  _do_report = options.do_report
+  if options.paths_from_git:
+    action_args = action_args + _get_paths_from_git(options.staged)
+  if paths_given:
+    _find_diffs_of_paths(action_args)
+  elif options.budget is not None:
+    _setup_local_repo_globals(options)
+    if not _find_diffs_within_budget(options.budget) and not _diffs_by_home_path and not _do_report:
+      print('No differences found so far.')
+      _save_config()
+      exit(0)
+  else:
+    _setup_local_repo_globals(options)
+    _find_diffs()
   if False: _debug_show_known_diffs()  # Turn this on if useful for debugging.
+  if _do_report: _finish_report()
   home_paths = list(_diffs_by_home_path.keys())
-  _show_diffs_in_order(home_paths)
-  path_index = _ask_user_for_diff_index(home_paths)
+  chosen_paths = set(_let_user_choose_diffs(home_paths))
   # If we get this far, then we're committed to the check and set up a new changed paths list.
   _add_new_changed_paths_list()
-  chosen_paths = [home_paths[path_index]] if path_index != -1 else home_paths
   # Filter out diffs the user has chosen to ignore for now.
   # Transitive closure may add more home paths, so we don't consult chosen_paths after this.
   for home_path in list(_diffs_by_home_path):
@@ -206,13 +347,51 @@ def _remind(action_args):
     print('Warning: ignoring the extra arguments %s' % ' '.join(action_args))
   _show_test_reminder()
 
-def _list(action_args):
+def _list(action_args, options):
   global _pairs
   if len(action_args) > 0:
     print('Warning: ignoring the extra arguments %s' % ' '.join(action_args))
-  repo_file_pairs = _find_repo_file_pairs()
-  for path1, path2 in repo_file_pairs: print(path1, path2)
-  for path1, path2 in _pairs:          print(path1, path2)
+  repo_pairs = None if options.do_rescan else _find_indexed_pairs()
+  if repo_pairs is None: repo_pairs = _find_repo_file_pairs()
+  show = _list_formats[options.list_format]
+  for path1, path2 in repo_pairs: show([path1, path2], ['home', 'copy'])
+  for path1, path2 in _pairs:     show([path1, path2], ['file', 'file'])
+  for group in _groups:           show(group, ['member'] * len(group))
+
+def _plan(action_args, options):
+  if len(action_args) > 1:
+    print('Expected at most one parameter, the plan file path.')
+    exit(2)
+  plan_path = action_args[0] if action_args else _default_plan_path
+  _setup_local_repo_globals(options)
+  _find_diffs()
+  steps, conflicts = _make_plan()
+  _save_plan(plan_path, steps, conflicts)
+  print('Saved a plan with %d step%s to %s' %
+        (len(steps), '' if len(steps) == 1 else 's', plan_path))
+  if conflicts:
+    print('%d file%s changed in more than one place; these are noted in the plan and left as is.' %
+          (len(conflicts), '' if len(conflicts) == 1 else 's'))
+  if steps:
+    print('Review or edit the plan, then run "syncer apply%s".' %
+          ('' if plan_path == _default_plan_path else ' ' + plan_path))
+
+def _apply(action_args):
+  global _changed_paths
+  if len(action_args) > 1:
+    print('Expected at most one parameter, the plan file path.')
+    exit(2)
+  plan_path = action_args[0] if action_args else _default_plan_path
+  if not os.path.isfile(plan_path):
+    print('Error: no plan found at %s; run "syncer plan" first.' % plan_path)
+    exit(1)
+  steps = _load_plan(plan_path)
+  waves = _order_plan_steps(steps)
+  _run_plan(waves)
+  _add_new_changed_paths_list()
+  _changed_paths[0].extend([dst for action, src, dst in steps])
+  print('Applied %d step%s from %s' % (len(steps), '' if len(steps) == 1 else 's', plan_path))
+  if _there_are_changed_paths(): _show_test_reminder()
 
 
 # internal functions
@@ -232,54 +411,513 @@ def _setup_local_repo_globals(options):
   print('Error: not in a known repo; use "syncer check --all" to check all possible connections.')
   exit(1)
 
-def _find_repo_file_pairs():
-  global _repos
-  repo_file_pairs = []
+# The list formats each print one line for a list of connected paths, given their roles; this is a
+# home/copy pair, a custom file pair, or a group. tsv and json lines also give the files' state,
+# which is one of same, differs, or missing.
+
+def _show_plain_list_line(paths, roles):
+  print(' '.join(paths), flush=True)
+
+def _show_tsv_list_line(paths, roles):
+  cols = [_list_state(paths, roles)]
+  for path, role in zip(paths, roles): cols += [role, path]
+  print('\t'.join(cols), flush=True)
+
+def _show_json_list_line(paths, roles):
+  files = [{'path': path, 'role': role} for path, role in zip(paths, roles)]
+  print(json.dumps({'state': _list_state(paths, roles), 'files': files}), flush=True)
+
+_list_formats = {'plain': _show_plain_list_line, 'tsv': _show_tsv_list_line,
+                 'json': _show_json_list_line}
+
+# Returns the sync state of connected paths for "syncer list". Home/copy pairs are compared by
+# their cached digests; custom pairs and groups are compared apart from line 3.
+def _list_state(paths, roles):
+  if not all([_isfile(path) for path in paths]): return 'missing'
+  digest = _file_digest if roles[0] == 'home' else _digest_without_line3
+  return 'same' if len(set([digest(path) for path in paths])) == 1 else 'differs'
+
+# Returns a generator of the [home_path, copy_path] pairs in ~/.syncer/pair_index if it's fresh,
+# and None otherwise. The pairs are read from the file as they're yielded.
+def _find_indexed_pairs():
+  file_path = os.path.join(_config_path, 'pair_index')
+  if not os.path.isfile(file_path): return None
+  f = open(file_path, 'r')
+  lines = (line.rstrip('\n') for line in f)
+  if next(lines, None) != _pair_index_header or next(lines, None) != '  config %s' % (
+      _pair_index_config_digest()):
+    f.close()
+    return None
+  for line in lines:
+    if line == '  pairs:': break
+    if line == '  dirs:': continue
+    mtime_ns, files_digest, dir_path = line.strip().split(' ', 2)
+    dir_path = json.loads(dir_path)
+    st = _stat(dir_path, keep=False)
+    try:
+      is_fresh = (st is not None and st.st_mtime_ns == int(mtime_ns) and
+                  _dir_files_digest(dir_path, _list_dir(dir_path)[0]) == files_digest)
+    except OSError:
+      is_fresh = False
+    if not is_fresh:
+      f.close()
+      return None
+  def pairs():
+    with f:
+      for line in lines: yield json.loads(line)
+  return pairs()
+
+# Returns a digest of the tracked repos and copy dirs, which determine the pairs found by a walk.
+def _pair_index_config_digest():
+  h = hashlib.sha1()
+  h.update(repr(sorted(_repos)).encode('utf-8'))
+  for home_name in sorted(_copy_dirs):
+    for copy_path, copy_info in sorted(_copy_dirs[home_name].items()):
+      h.update(repr((home_name, copy_path, copy_info['tracking'], copy_info['home_path'],
+                     sorted(copy_info['excluded']))).encode('utf-8'))
+  return h.hexdigest()
+
+# Compares every known file connection, accumulating differences in _diffs_by_home_path.
+# Pairs are compared as the scan finds them, so no list of all pairs is built. When printing to a
+# terminal without --report, a running count of compared pairs is shown.
+def _find_diffs():
+  print('Checking for differences.')
+  show_progress = (not _do_report and sys.stdout.isatty())
+  num_compared, last_shown = 0, 0
+  for home_file_path, copy_path in _find_repo_file_pairs(skip_same_dirs=True):
+    _compare_full_paths(home_file_path, copy_path)
+    num_compared += 1
+    if show_progress and time.monotonic() - last_shown > 0.1:
+      _show_progress(num_compared)
+      last_shown = time.monotonic()
+  for path1, path2 in _pairs:
+    _compare_full_paths(path1, path2, ignore_line3=True)
+  for group in _groups:
+    _compare_group(group)
+  if show_progress:
+    _show_progress(num_compared)
+    print('')
+
+# Like _find_diffs, but works in order of recency and stops once budget_ms milliseconds have
+# passed. Custom pairs and groups go first, newest first, followed by the tracked repos in the
+# order of _find_repo_dirs_by_recency. Returns True iff everything was checked; otherwise this
+# prints an estimate of how much was left unchecked, based on the number of cached files.
+def _find_diffs_within_budget(budget_ms):
+  print('Checking for differences, most recently changed files first.')
+  deadline = time.monotonic() + budget_ms / 1000
+  show_progress = (not _do_report and sys.stdout.isatty())
+  num_known_files, _ = _load_dir_recency()
+  num_files_scanned, num_compared, last_shown, is_out_of_time = 0, 0, 0, False
+  def newest_mtime(paths): return max([_getmtime(path) if _isfile(path) else 0 for path in paths])
+  path_lists = sorted([(pair, True) for pair in _pairs] + [(group, False) for group in _groups],
+                      key=lambda item: newest_mtime(item[0]), reverse=True)
+  num_lists_checked = 0
+  for paths, is_pair in path_lists:
+    if time.monotonic() > deadline: break
+    if is_pair:
+      _compare_full_paths(paths[0], paths[1], ignore_line3=True)
+    else:
+      _compare_group(paths)
+    num_lists_checked += 1
+  def dirs_within_budget():
+    nonlocal num_files_scanned, is_out_of_time
+    for name, dir_path, files in _find_repo_dirs_by_recency():
+      if time.monotonic() > deadline:
+        is_out_of_time = True
+        return
+      num_files_scanned += len(files)
+      yield name, dir_path, files
+  if num_lists_checked < len(path_lists):
+    is_out_of_time = True
+  else:
+    for home_file_path, copy_path in _find_repo_file_pairs(repo_dirs=dirs_within_budget()):
+      _compare_full_paths(home_file_path, copy_path)
+      num_compared += 1
+      if show_progress and time.monotonic() - last_shown > 0.1:
+        _show_progress(num_compared)
+        last_shown = time.monotonic()
+      if time.monotonic() > deadline:
+        is_out_of_time = True
+        break
+  if show_progress:
+    _show_progress(num_compared)
+    print('')
+  if not is_out_of_time:
+    _prune_cached_info()  # Every tracked file has been seen.
+    return True
+  print('Stopped after the %d ms budget.' % budget_ms)
+  if num_lists_checked < len(path_lists):
+    print('%d of %d custom file pairs and groups are unchecked.' %
+          (len(path_lists) - num_lists_checked, len(path_lists)))
+  if num_known_files > num_files_scanned:
+    num_unchecked = num_known_files - num_files_scanned
+    print('About %d of %d files (%d%%) in tracked repos are unchecked.' %
+          (num_unchecked, num_known_files, 100 * num_unchecked // num_known_files))
+  else:
+    print('Scanned %d files in tracked repos; an unknown number are unchecked.' %
+          num_files_scanned)
+  return False
+
+def _show_progress(num_compared):
+  print('\rCompared %d file pairs; %d files differ.' % (num_compared, len(_diffs_by_home_path)),
+        end='', flush=True)
+
+# Compares only the connections of the given files, found from their line-3 markers, the copy-dir
+# index, and the tracked file pairs and groups. This costs time proportional to the number of
+# given files rather than to the size of the tracked repos. Copies that are only known from their
+# own "in <subdir>" markers aren't found from their home files.
+def _find_diffs_of_paths(paths):
+  print('Checking for differences.')
+  conns, groups = set(), []
+  for path in paths:
+    path = os.path.abspath(path)
+    conns.update(_find_conns_of_path(path))
+    for path1, path2 in _pairs:
+      if path in (path1, path2): conns.add((path1, path2, True))
+    group = _find_group([path])
+    if group and group not in groups: groups.append(group)
+  for path1, path2, ignore_line3 in sorted(conns):
+    _compare_full_paths(path1, path2, ignore_line3)
+  for group in groups:
+    _compare_group(group)
+
+# Returns the (name, root) of the innermost tracked repo containing path, or (None, None).
+def _find_repo_of_path(path):
+  best_name, best_root = None, None
   for name, root in _repos:
-    for path, dirs, files in os.walk(root):
-      dirs[:] = [d for d in dirs if not _should_skip_dir(d)]
-      for filename in files:
-        filepath = os.path.join(path, filename)
-        home_info = _check_for_home_info(filepath)
-        if home_info is None:    continue
-        filedir = os.path.dirname(filepath)
-
-        # Check to see if this file is missing in a copy directory.
-        if home_info[0] == name:
-          if name not in _copy_dirs: continue
-          for copy_path, copy_info in _copy_dirs[name].items():
-            if not copy_info['tracking']: continue
-            copys_home_path = copy_info['home_path']
-            if not filedir.startswith(copys_home_path): continue
-            subpath = filepath[len(copys_home_path) + 1:]
-            if _is_rel_path_excluded(subpath, copy_info): continue
-            # Check if the copy's version of the file exists.
-            copy_file_path = os.path.join(copy_path, subpath)
-            if os.path.isfile(copy_file_path): continue
-            repo_file_pairs.append([filepath, copy_file_path])
-            key = (filepath, copy_file_path)
-            _gone_file_metadata[key] = copy_info
-          continue
+    if path.startswith(root + os.sep) and (best_root is None or len(root) > len(best_root)):
+      best_name, best_root = name, root
+  return best_name, best_root
+
+# Returns a set of (home_path, copy_path, False) connections of the file at path within tracked
+# repos. The file may have been deleted, in which case its cached line-3 info is used.
+def _find_conns_of_path(path):
+  conns = set()
+  name, root = _find_repo_of_path(path)
+  if name is None: return conns
+  if _isfile(path):
+    home_info = _check_for_home_info(path)
+  else:
+    dir_path, base = os.path.split(path)
+    info = _cached_info_by_dir.get(dir_path, {}).get(base)
+    home_info = info[:2] if info and info[0] else (name, None)
+  if home_info is None: return conns
+  if home_info[0] == name:
+    # path is a home file; its copies are found from the copy dirs mirroring its directory.
+    for copy_info in _trie_values_along(_copy_infos_by_home_dir.get(name, {}),
+                                        os.path.dirname(path)):
+      if not copy_info['tracking']: continue
+      subpath = path[len(copy_info['home_path']) + 1:]
+      if _is_rel_path_excluded(subpath, copy_info): continue
+      copy_file_path = os.path.join(copy_info['copy_path'], subpath)
+      conns.add((path, copy_file_path, False))
+      _gone_file_metadata[(path, copy_file_path)] = copy_info
+    return conns
+  home_path, home_subpath, was_found = _find_home_path(home_info, path)
+  if home_path is not None: conns.add((home_path, path, False))
+  return conns
+
+# Returns the absolute paths of files listed by "git diff --name-only" for the current directory's
+# git repo, using the staged changes if staged is True.
+def _get_paths_from_git(staged):
+  def run_git(git_args):
+    try:
+      result = subprocess.run(['git'] + git_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+      print('Error: unable to run git: %s' % e)
+      exit(1)
+    if result.returncode != 0:
+      print('Error: "git %s" failed:' % ' '.join(git_args))
+      print(result.stderr.decode('utf-8', 'replace').rstrip())
+      exit(1)
+    return os.fsdecode(result.stdout)
+  top = run_git(['rev-parse', '--show-toplevel']).rstrip('\n')
+  names = run_git(['diff', '--name-only', '-z'] + (['--cached'] if staged else []))
+  return [os.path.join(top, name) for name in names.split('\0') if name]
+
+# Ends a --report check, whose differences have already been printed by _add_diff; this exits
+# with status 1 if there were any.
+def _finish_report():
+  if _num_reported_diffs == 0:
+    print('No differences found.')
+    _save_config()
+    exit(0)
+  print('Run "syncer check" to resolve these differences.')
+  _save_config()
+  exit(1)
+
+# Yields [home_path, copy_path] pairs for all tracked repos as they're found.
+# If skip_same_dirs is True, files in tracked copy dirs are collected per copy dir and only the
+# pairs within subtrees whose digests differ are yielded, after the walk; see _find_copy_dir_pairs.
+# repo_dirs is an iterable of (repo_name, dir_path, filenames) to scan instead of walking every
+# repo with _walk_repo_dirs. Only a full walk prunes stale cached info and saves the pair index;
+# its pairs are written to a temporary file as they're found, rather than kept in memory.
+def _find_repo_file_pairs(skip_same_dirs=False, repo_dirs=None):
+  if repo_dirs is not None:
+    yield from _scan_for_file_pairs(repo_dirs, skip_same_dirs)
+    return
+  if not os.path.isdir(_config_path): os.mkdir(_config_path)
+  dir_states = {}
+  with tempfile.TemporaryFile('w+', dir=_config_path) as pairs_file:
+    def add_pair(pair): pairs_file.write('    %s\n' % json.dumps(pair))
+    for pair in _scan_for_file_pairs(_walk_repo_dirs(dir_states), skip_same_dirs, add_pair):
+      add_pair(pair)
+      yield pair
+    # Every tracked file has now been seen, so anything else in the cache is stale.
+    _prune_cached_info()
+    _save_pair_index(dir_states, pairs_file)
+
+# Yields the [home_path, copy_path] pairs of the files in repo_dirs for _find_repo_file_pairs. If
+# add_same_pair is given, it's called with each pair found to be identical without being yielded.
+def _scan_for_file_pairs(repo_dirs, skip_same_dirs, add_same_pair=None):
+  global _repos
+  # {id(copy_info): (copy_info, {rel_path: home_file_path}, {rel_path: copy_file_path})}
+  files_of_copy_dir = {}
+  # Pairs with a missing file are yielded after the scan, as a file seen later may show that a home
+  # file was moved. These hold [(copy_file_path, home_info)] for copies whose home file wasn't
+  # found, and [(home_file_path, copy_file_path, copy_info)] for home files whose copy wasn't found.
+  unfound_homes, missing_copies = [], []
+  for name, path, files in repo_dirs:
+    for filename in files:
+      filepath = os.path.join(path, filename)
+      home_info = _check_for_home_info(filepath)
+      if home_info is None:    continue
+      filedir = os.path.dirname(filepath)
+
+      # Check to see if this file is missing in a copy directory.
+      if home_info[0] == name:
+        _index_home_file(filepath)
+        if name not in _copy_infos_by_home_dir: continue
+        for copy_info in _trie_values_along(_copy_infos_by_home_dir[name], filedir):
+          if not copy_info['tracking']: continue
+          copy_path = copy_info['copy_path']
+          subpath = filepath[len(copy_info['home_path']) + 1:]
+          if _is_rel_path_excluded(subpath, copy_info): continue
+          copy_file_path = os.path.join(copy_path, subpath)
+          if skip_same_dirs:
+            if _innermost_copy_info(copy_file_path, name) is copy_info:
+              files = files_of_copy_dir.setdefault(id(copy_info), (copy_info, {}, {}))
+              files[1][subpath] = filepath
+            continue
+          if not _isfile(copy_file_path):
+            missing_copies.append((filepath, copy_file_path, copy_info))
+        continue
 
-        home_path, home_subpath, was_found = _find_home_path(home_info, filepath)
-        if home_path is None: continue  # An error is already printed by _find_home_path.
-        repo_file_pairs.append([home_path, filepath])
-
-        if was_found:
-          # Update directory-tracking data.
-          home_dir_path = os.path.dirname(home_path)
-          home_root = home_path[:len(home_path) - len(home_subpath) - len(filename) - 2]
-          default_copy_info = {'tracking': True, 'excluded': set(),
-                               'home_path': home_dir_path, 'home_root': home_root,
-                               'copy_path': filedir}
-          copy_info_by_copy_path = _copy_dirs.setdefault(home_info[0], {})
-          if filedir in copy_info_by_copy_path:
-            if copy_info_by_copy_path[filedir]['home_path'] != default_copy_info['home_path']:
-              print('Warning: multiple home directories from a single repo mapped into single',
-                    'copy dir %s;' % filedir,
-                    'syncer may not correctly handle file additions/deletions in this case.')
-          copy_info_by_copy_path.setdefault(filedir, default_copy_info)
-  return repo_file_pairs
+      home_path, home_subpath, was_found = _find_home_path(home_info, filepath)
+      if home_path is None: continue  # An error is already printed by _find_home_path.
+      copy_info = _innermost_copy_info(filepath, home_info[0]) if skip_same_dirs else None
+      if copy_info and copy_info['tracking']:
+        subpath = filepath[len(copy_info['copy_path']) + 1:]
+        if os.path.join(copy_info['home_path'], subpath) == home_path:
+          files = files_of_copy_dir.setdefault(id(copy_info), (copy_info, {}, {}))
+          files[2][subpath] = filepath
+          continue
+      if not was_found and not _isfile(home_path):
+        unfound_homes.append((filepath, home_info))
+        continue
+      yield [home_path, filepath]
+
+      if was_found:
+        # Update directory-tracking data.
+        home_dir_path = os.path.dirname(home_path)
+        home_root = home_path[:len(home_path) - len(home_subpath) - len(filename) - 2]
+        default_copy_info = {'tracking': True, 'excluded': set(),
+                             'home_path': home_dir_path, 'home_root': home_root,
+                             'copy_path': filedir}
+        copy_info_by_copy_path = _copy_dirs.get(home_info[0], {})
+        if filedir in copy_info_by_copy_path:
+          if copy_info_by_copy_path[filedir]['home_path'] != default_copy_info['home_path']:
+            print('Warning: multiple home directories from a single repo mapped into single',
+                  'copy dir %s;' % filedir,
+                  'syncer may not correctly handle file additions/deletions in this case.')
+        else:
+          _add_copy_dir(home_info[0], default_copy_info)
+  for copy_info, home_files, copy_files in files_of_copy_dir.values():
+    yield from _find_copy_dir_pairs(copy_info, home_files, copy_files, add_same_pair)
+  for filepath, home_info in unfound_homes:
+    _known_home_paths.pop((home_info[0], home_info[1], os.path.basename(filepath)), None)
+    home_path, _, _ = _find_home_path(home_info, filepath)
+    if home_path is not None: yield [home_path, filepath]
+  for filepath, copy_file_path, copy_info in missing_copies:
+    # The copy's version of the file may still be at the home file's old path.
+    if copy_info['copy_path'] in _copy_dirs_of_moved_path.get(filepath, ()): continue
+    _gone_file_metadata[(filepath, copy_file_path)] = copy_info
+    yield [filepath, copy_file_path]
+
+# Yields (repo_name, dir_path, filenames) for every directory of every tracked repo, in the same
+# order as os.walk. If dir_states is given, each dir's (mtime_ns, files digest) is stored there; the
+# mtime is read before the dir is listed, so that a later change to the listing always changes it,
+# and the digest after the dir's files have been scanned, so that it can use their fingerprints.
+def _walk_repo_dirs(dir_states=None):
+  for name, root in _repos:
+    dir_paths = [root]
+    while dir_paths:
+      path = dir_paths.pop()
+      st = _stat(path, keep=False) if dir_states is not None else None
+      if dir_states is not None and st is None: continue
+      try:
+        files, subdirs = _list_dir(path)
+      except OSError:
+        continue
+      dir_paths.extend([os.path.join(path, d) for d in reversed(subdirs)])
+      yield name, path, files
+      if st is not None: dir_states[path] = (st.st_mtime_ns, _dir_files_digest(path, files))
+
+# Returns (filenames, subdir_names) for the dir at path, leaving out subdirs that aren't walked.
+def _list_dir(path):
+  with os.scandir(path) as scanned:
+    entries = list(scanned)
+  files = [entry.name for entry in entries if not entry.is_dir()]
+  subdirs = [entry.name for entry in entries
+             if entry.is_dir(follow_symlinks=False) and not _should_skip_dir(entry.name)]
+  return files, subdirs
+
+# Returns a digest of the names and stat fingerprints of the given files in dir_path. Which files
+# pair up depends on their contents, so this changes whenever a file that's edited in place could
+# have gained or lost a pair. Fingerprints cached during this run are used without a new stat.
+def _dir_files_digest(dir_path, files):
+  info_by_base = _cached_info_by_dir.get(dir_path, {})
+  h = hashlib.sha1()
+  for filename in sorted(files):
+    info = info_by_base.get(filename)
+    if info is not None and info[3] == _run_time:
+      fingerprint = info[2]
+    else:
+      st = _stat(os.path.join(dir_path, filename), keep=False)
+      fingerprint = st and _stat_fingerprint(st)
+    h.update(repr((filename, fingerprint)).encode('utf-8'))
+  return h.hexdigest()
+
+# Yields (repo_name, dir_path, filenames) for every directory of every tracked repo, like
+# _walk_repo_dirs, but starting with the directories most likely to hold fresh edits: those of
+# recently changed paths, then those ranked by _save_dir_recency, which are read as needed so that
+# the first dirs are yielded at once. A changed dir's mirroring copy dirs are ranked with it.
+# Files are ordered newest first, and the remaining directories follow in os.walk order.
+def _find_repo_dirs_by_recency():
+  priority_of_changed_dir = {}
+  for i, paths in _changed_paths.items():
+    for path in paths:
+      for dir_path in [os.path.dirname(path)] + _mirroring_copy_dirs(os.path.dirname(path)):
+        priority_of_changed_dir[dir_path] = max(priority_of_changed_dir.get(dir_path, -1), -i)
+  changed_dirs = sorted(priority_of_changed_dir, key=priority_of_changed_dir.get, reverse=True)
+  _, ranked_dirs = _load_dir_recency()
+  done_dirs = set()
+  for dir_path in itertools.chain(changed_dirs, ranked_dirs):
+    if dir_path in done_dirs: continue
+    names = [name for name, root in _repos
+             if (dir_path + os.sep).startswith(root + os.sep) and
+             not any([_should_skip_dir(d) for d in dir_path[len(root):].split(os.sep)])]
+    if not names: continue
+    try:
+      with os.scandir(dir_path) as entries:
+        files = [entry.name for entry in entries if not entry.is_dir()]
+    except OSError:
+      continue  # The dir may have been deleted since it was cached.
+    info_by_base = _cached_info_by_dir.get(dir_path, {})
+    files.sort(key=lambda base: info_by_base[base][2][0] if base in info_by_base else _run_time,
+               reverse=True)
+    done_dirs.add(dir_path)
+    for name in names: yield name, dir_path, files
+  for name, path, files in _walk_repo_dirs():
+    if path not in done_dirs: yield name, path, files
+
+# Returns the copy dirs that mirror dir_path, where its changes show up as differences.
+def _mirroring_copy_dirs(dir_path):
+  copy_dirs = []
+  for copy_infos_by_home_dir in _copy_infos_by_home_dir.values():
+    for copy_info in _trie_values_along(copy_infos_by_home_dir, dir_path):
+      copy_dirs.append(copy_info['copy_path'] + dir_path[len(copy_info['home_path']):])
+  return copy_dirs
+
+# Returns the copy_info of the innermost copy dir of home_name that contains path, or None.
+def _innermost_copy_info(path, home_name):
+  copy_info = None
+  if home_name not in _copy_infos_by_copy_dir: return None
+  for copy_info in _trie_values_along(_copy_infos_by_copy_dir[home_name], os.path.dirname(path)):
+    pass
+  return copy_info
+
+# Builds a Merkle tree from a {rel_path: file_path} dict. A file node is (digest, file_path) and a
+# directory node is (digest, {name: node}), where a directory's digest covers the names and digests
+# of everything below it.
+def _merkle_tree(files):
+  root = {}
+  for rel_path, file_path in files.items():
+    parts = rel_path.split(os.sep)
+    node = root
+    for part in parts[:-1]: node = node.setdefault(part, {})
+    node[parts[-1]] = file_path
+  def digest_node(node):
+    if isinstance(node, str): return (_file_digest(node), node)
+    children = {name: digest_node(child) for name, child in node.items()}
+    h = hashlib.sha1()
+    for name in sorted(children):
+      kind = 'f' if isinstance(children[name][1], str) else 'd'
+      h.update(('%s %s %s\n' % (kind, children[name][0], name)).encode('utf-8', 'surrogateescape'))
+    return (h.hexdigest(), children)
+  return digest_node(root)
+
+# Yields every file_path in a Merkle tree node.
+def _merkle_files(node):
+  if isinstance(node[1], str):
+    yield node[1]
+    return
+  for child in node[1].values(): yield from _merkle_files(child)
+
+# Compares the Merkle trees of a home dir and its copy dir. Identical subtrees are only recorded in
+# _conns_by_path, and passed to add_same_pair if given; pairs are yielded for files within subtrees
+# whose digests differ, including files missing on one side. A copy whose home file has moved is
+# paired with the moved file, which then isn't reported as missing a copy.
+def _find_copy_dir_pairs(copy_info, home_files, copy_files, add_same_pair=None):
+  home_path, copy_path = copy_info['home_path'], copy_info['copy_path']
+  home_only, copy_only = [], []  # One-sided nodes, handled once the moved home files are known.
+  def add_same_subtree(node):
+    for file_path in _merkle_files(node):
+      rel = file_path[len(copy_path) + 1:]
+      home_file_path, file_path = _intern(os.path.join(home_path, rel)), _intern(file_path)
+      _add_conn(home_file_path, file_path)
+      if add_same_pair is not None: add_same_pair([home_file_path, file_path])
+  def add_one_sided(node, is_home_side):
+    (home_only if is_home_side else copy_only).append(node)
+  def one_sided_pairs():
+    for node in copy_only:
+      for file_path in _merkle_files(node):
+        home_file_path = os.path.join(home_path, file_path[len(copy_path) + 1:])
+        moved_path = _find_moved_home_path(home_file_path, file_path, copy_info['home_root'])
+        if moved_path:
+          _note_home_move(copy_info, home_file_path, moved_path)
+          _copy_dirs_of_moved_path.setdefault(moved_path, set()).add(copy_path)
+          home_file_path = moved_path
+        yield [home_file_path, file_path]
+    for node in home_only:
+      for file_path in _merkle_files(node):
+        if copy_path in _copy_dirs_of_moved_path.get(file_path, ()): continue
+        copy_file_path = os.path.join(copy_path, file_path[len(home_path) + 1:])
+        if _isfile(copy_file_path): continue  # The copy may lack its line-3 marker.
+        _gone_file_metadata[(file_path, copy_file_path)] = copy_info
+        yield [file_path, copy_file_path]
+  def compare(home_node, copy_node):
+    if home_node[0] == copy_node[0]:
+      add_same_subtree(copy_node)
+      return
+    home_is_file, copy_is_file = isinstance(home_node[1], str), isinstance(copy_node[1], str)
+    if home_is_file and copy_is_file:
+      yield [home_node[1], copy_node[1]]
+      return
+    if home_is_file or copy_is_file:  # A file on one side and a directory on the other.
+      add_one_sided(home_node, True)
+      add_one_sided(copy_node, False)
+      return
+    home_children, copy_children = home_node[1], copy_node[1]
+    for name in set(home_children) | set(copy_children):
+      if name not in copy_children:
+        add_one_sided(home_children[name], True)
+      elif name not in home_children:
+        add_one_sided(copy_children[name], False)
+      else:
+        yield from compare(home_children[name], copy_children[name])
+  yield from compare(_merkle_tree(home_files), _merkle_tree(copy_files))
+  yield from one_sided_pairs()
 
 def _debug_show_known_diffs():
   print('Comparisons are done in _check.')
@@ -314,38 +952,140 @@ def _show_test_reminder(how_recent=[0]):
     quantity_strs = ('', '') if num_runs == 1 else (str(num_runs) + ' ', 's')
     print('No files changed during last %srun%s of syncer check.' % quantity_strs)
 
-# Shows something like the following for each given home_path:
-#   [1] <basename> [in repo name if not unique]
-#         uniq_subpath:basename > uniq_subpath:basename
-def _show_diffs_in_order(home_paths):
+# Shows a summary of the differences in home_paths and returns the home paths the user chooses to
+# handle. A few differences are listed individually; more are shown in pages of groups.
+def _let_user_choose_diffs(home_paths):
   if len(home_paths) == 0:
     print('No differences found.')
     print('All good!')
     _save_config()
     exit(0)
-  print('Differences found:')
-  # Find column widths.
-  uniq1_max, uniq2_max, base_max = 0, 0, 0
+  if len(home_paths) <= _max_ungrouped_diffs:
+    _show_diffs_in_order(_summarize_diffs(home_paths))
+    path_index = _ask_user_for_diff_index(home_paths)
+    return [home_paths[path_index]] if path_index != -1 else home_paths
+  groups = _group_diffs(home_paths)
+  return _let_user_choose_diff_groups(groups)
+
+# Returns a summary row for each home path; rows have the form
+#   (home_path, title, [(uniq_subpath1, uniq_subpath2, cmp_str)])
+# where title is the basename, followed by the home_path if the basename isn't unique.
+def _summarize_diffs(home_paths):
+  rows = []
   for home_path in home_paths:
     base = os.path.basename(home_path)
-    base_max = max(len(base), base_max)
+    title = base if len(_paths_by_basename[base]) == 1 else (base + ' in ' + home_path)
+    cols = []
     for diff_path, ignore_line3 in _diffs_by_home_path[home_path]:
       uniq1, uniq2 = _get_uniq_subpaths(home_path, diff_path)
+      cmp_str = _compare_paths_by_time(home_path, diff_path).center(13)
+      cols.append((uniq1, uniq2, cmp_str))
+    rows.append((home_path, title, cols))
+  return rows
+
+# Returns a format string for printing the columns of the given summary rows.
+def _diff_row_fmt(rows):
+  uniq1_max, uniq2_max, base_max = 0, 0, 0
+  for home_path, title, cols in rows:
+    base_max = max(len(os.path.basename(home_path)), base_max)
+    for uniq1, uniq2, cmp_str in cols:
       uniq1_max = max(len(uniq1), uniq1_max)
       uniq2_max = max(len(uniq2), uniq2_max)
   # fmt will end up as something like '         %20s: %10s %s %15s: %10s'.
-  fmt = '%7s %%%ds: %%%ds %%s %%%ds: %%%ds' % ('', uniq1_max, base_max, uniq2_max, base_max)
-  for i, home_path in enumerate(home_paths):
+  return '%7s %%%ds: %%%ds %%s %%%ds: %%%ds' % ('', uniq1_max, base_max, uniq2_max, base_max)
+
+# Shows something like the following for each given summary row:
+#   [1] <basename> [in repo name if not unique]
+#         uniq_subpath:basename > uniq_subpath:basename
+def _show_diffs_in_order(rows):
+  print('Differences found:')
+  fmt = _diff_row_fmt(rows)
+  for i, (home_path, title, cols) in enumerate(rows):
     prefix = '  [%d] ' % (i + 1) if i < 9 else '  [ ] '
+    print('\n' + prefix + title)
     base = os.path.basename(home_path)
-    suffix = '' if len(_paths_by_basename[base]) == 1 else (' in ' + home_path)
-    print('\n' + prefix + base + suffix)
-    for diff_path, ignore_line3 in _diffs_by_home_path[home_path]:
-      uniq1, uniq2 = _get_uniq_subpaths(home_path, diff_path)
-      cmp_str = _compare_paths_by_time(home_path, diff_path).center(13)
+    for uniq1, uniq2, cmp_str in cols:
       print(fmt % (uniq1, base, cmp_str, uniq2, base))
   print('')  # End-of-section newline.
 
+# Returns the name of the group a home path is summarized in; this has the form
+# "<repo name>: <dir within repo>", or is just the dir for paths outside of any repo.
+def _diff_group_name(home_path):
+  if home_path == _unknown_home_path: return _unknown_home_path
+  dir_path = os.path.dirname(home_path)
+  best_root, best_name = '', None
+  for name, root in _repos:
+    if len(root) > len(best_root) and (dir_path + os.sep).startswith(root + os.sep):
+      best_root, best_name = root, name
+  if best_name is None: return dir_path
+  return '%s: %s' % (best_name, dir_path[len(best_root) + 1:] or '.')
+
+# Returns a sorted list of (group_name, [home_path]) pairs.
+def _group_diffs(home_paths):
+  paths_by_group = {}
+  for home_path in home_paths:
+    paths_by_group.setdefault(_diff_group_name(home_path), []).append(home_path)
+  return [(name, sorted(paths)) for name, paths in sorted(paths_by_group.items())]
+
+# Shows pages of difference groups and returns the home paths of the groups the user chooses.
+# Summary rows are only computed for groups as their page is shown.
+def _let_user_choose_diff_groups(groups):
+  num_diffs = sum([len(paths) for name, paths in groups])
+  per_page = max(1, (_term_rows - 8) // (_rows_per_group + 3))
+  rows_of_group = {}
+  page_start = 0
+  while True:
+    page_end = min(page_start + per_page, len(groups))
+    for i in range(page_start, page_end):
+      if i not in rows_of_group: rows_of_group[i] = _summarize_diffs(groups[i][1])
+    print('Differences found in %d files, in %d groups; showing groups %d-%d:' %
+          (num_diffs, len(groups), page_start + 1, page_end))
+    fmt = _diff_row_fmt(sum([rows_of_group[i] for i in range(page_start, page_end)], []))
+    for i in range(page_start, page_end):
+      name, paths = groups[i]
+      print('\n  [%d] %s (%d file%s)' % (i + 1, name, len(paths), '' if len(paths) == 1 else 's'))
+      lines = [(home_path, col) for home_path, title, cols in rows_of_group[i] for col in cols]
+      for home_path, (uniq1, uniq2, cmp_str) in lines[:_rows_per_group]:
+        base = os.path.basename(home_path)
+        print(fmt % (uniq1, base, cmp_str, uniq2, base))
+      if len(lines) > _rows_per_group:
+        print('%7s ... and %d more' % ('', len(lines) - _rows_per_group))
+    print('')  # End-of-section newline.
+    print(_horiz_break)
+    ok_chars = ['g', 'a']
+    page_strs = []
+    if page_end < len(groups):
+      ok_chars.append('n')
+      page_strs.append('[n]ext page; ')
+    if page_start > 0:
+      ok_chars.append('p')
+      page_strs.append('[p]revious page; ')
+    print('Actions: %s[g]o handle some groups; handle [a]ll files; [q]uit.' % ''.join(page_strs))
+    print('What would you like to do?')
+    c = _wait_for_key_in_list(ok_chars)
+    if c == 'n': page_start = page_end
+    if c == 'p': page_start = max(0, page_start - per_page)
+    if c == 'a': return [path for name, paths in groups for path in paths]
+    if c == 'g':
+      indexes = _ask_user_for_index_ranges(len(groups))
+      return [path for i in indexes for path in groups[i][1]]
+
+# Reads a line such as "3" or "2-5, 9" and returns the 0-based indexes it lists.
+# Every listed number must be in the range [1, num_items].
+def _ask_user_for_index_ranges(num_items):
+  while True:
+    line = input('Which groups (e.g. 3 or 2-5, 9)? ')
+    indexes = []
+    for part in line.replace(' ', '').split(','):
+      m = re.match(r'(\d+)(?:-(\d+))?$', part)
+      if m is None: break
+      first, last = int(m.group(1)), int(m.group(2) or m.group(1))
+      if first < 1 or last > num_items or first > last: break
+      indexes.extend(range(first - 1, last))
+    else:
+      if indexes: return sorted(set(indexes))
+    print('Please enter numbers or ranges from 1 to %d, separated by commas.' % num_items)
+
 # Removes the common prefix and suffix from the given pair.
 # Expects the paths to be unequal, but the file names to match.
 # In other words, given strings of the form ABC, ADC, this returns B, D.
@@ -364,10 +1104,10 @@ def _get_uniq_subpaths(path1, path2):
 # Returns a comparison result string based on the files' timestamps.
 # Return values are '<-newer  ', '  newer->' or '!='.
 def _compare_paths_by_time(path1, path2):
-  if not os.path.isfile(path1): return " <- doesn't exist    "
-  if not os.path.isfile(path2): return "    doesn't exist -> "
-  t1 = os.path.getmtime(path1)
-  t2 = os.path.getmtime(path2)
+  if not _isfile(path1): return " <- doesn't exist    "
+  if not _isfile(path2): return "    doesn't exist -> "
+  t1 = _getmtime(path1)
+  t2 = _getmtime(path2)
   # For reference:   '    doesn't exist    '
   if t1 < t2: return '      newer   -> '
   if t1 > t2: return ' <-   newer      '
@@ -423,7 +1163,7 @@ def _let_user_handle_add_or_delete_diff(home_path, home_exists, copy_path, copy_
 
 def _let_user_handle_standard_diff(home_path, copy_path, ignore_line3):
   # Determine which file version is older.
-  home_is_older = (os.path.getmtime(home_path) < os.path.getmtime(copy_path))
+  home_is_older = (_getmtime(home_path) < _getmtime(copy_path))
   oldpath, newpath = (home_path, copy_path) if home_is_older else (copy_path, home_path)
 
   # Build and print diff strings.
@@ -434,7 +1174,9 @@ def _let_user_handle_standard_diff(home_path, copy_path, ignore_line3):
   show_and_save('')
   show_and_save('Diff between:')
   show_and_save('older: ' + oldpath)
+  for mate in _group_mates.get(oldpath, []): show_and_save('       (same as ' + mate + ')')
   show_and_save('newer: ' + newpath)
+  for mate in _group_mates.get(newpath, []): show_and_save('       (same as ' + mate + ')')
   show_and_save('')
   short1, short2 = _short_names(oldpath, newpath)
   diff = difflib.unified_diff(
@@ -465,8 +1207,8 @@ def _show_and_let_user_act_on_diff(home_path, copy_path, ignore_line3):
     print(_diff_header % ('start ' + base).center(_basename_width))
 
   # Distinguish between a standard and an add/delete diff.
-  home_exists = os.path.isfile(home_path)
-  copy_exists = os.path.isfile(copy_path)
+  home_exists = _isfile(home_path)
+  copy_exists = _isfile(copy_path)
 
   # Show diff and act on user feedback.
   if ignore_line3 or (home_exists and copy_exists):
@@ -514,7 +1256,7 @@ def _let_user_act_on_add_or_delete_diff(here_path, gone_path, diff):
     print('Untracked')
   if c == 'x':
     rel_path_to_gone_file = gone_path[len(copy_info['copy_path']) + 1:]
-    copy_info['excluded'].add(rel_path_to_gone_file)
+    _exclude_rel_path(copy_info, rel_path_to_gone_file)
     print('File excluded')
   if c == 'w':
     base = os.path.basename(here_path).replace('.', '_')
@@ -543,6 +1285,12 @@ def _let_user_act_on_diff(newpath, oldpath, diff, ignore_line3):
   fmt += '  [r]everse copy %s to %s;\n'
   fmt += '  [s]kip this file; [w]rite diff file and quit; [q]uit.'
   print(fmt % (new_short, old_short, old_short, new_short))
+  for path in [oldpath, newpath]:
+    num_mates = len(_group_mates.get(path, []))
+    if num_mates:
+      print('(A copy to %s is also made to %d matching group member%s.)' %
+            (old_short if path == oldpath else new_short, num_mates,
+             '' if num_mates == 1 else 's'))
   print('What would you like to do?')
   c = _wait_for_key_in_list(list('crws'))
   if c == 'c':
@@ -585,10 +1333,10 @@ def _wait_for_key_in_list(ok_chars):
 
 def _copy_src_to_dst(src, dst, preserve_line3=False):
   global _changed_paths
+  _forget_stat(dst)
   if not preserve_line3:
     dst_dir = os.path.dirname(dst)
-    if not os.path.exists(dst_dir):
-      os.makedirs(dst_dir)
+    os.makedirs(dst_dir, exist_ok=True)
     shutil.copy2(src, dst)
     return
   # Preserve line 3.
@@ -601,12 +1349,19 @@ def _copy_src_to_dst(src, dst, preserve_line3=False):
 def _copy_src_to_dst_and_update_metadata(src, dst, preserve_line3=False):
   _copy_src_to_dst(src, dst, preserve_line3)
   _changed_paths[0].append(dst)
+  # Group members that matched dst are updated along with it.
+  mates = _group_mates.pop(dst, [])
+  for mate in mates:
+    _copy_src_to_dst(src, mate, preserve_line3=True)
+    _changed_paths[0].append(mate)
   # Check for other files affected by this change.
-  for home_path, copy_path, ignore_line3 in _conns_by_path[dst]:
-    _compare_full_paths(home_path, copy_path, ignore_line3)
+  for path in [dst] + mates:
+    for home_path, copy_path, ignore_line3 in _conns_by_path[path]:
+      _compare_full_paths(home_path, copy_path, ignore_line3)
 
 def _delete_path_and_update_metadata(path):
   os.remove(path)
+  _forget_stat(path)
   _changed_paths[0].append(path)
   # Check for other files affected by this change.
   for home_path, copy_path, ignore_line3 in _conns_by_path[path]:
@@ -635,20 +1390,25 @@ def _get_homeinfo_regex():
   return _homeinfo_regex
 
 # Checks for a recognized repo name on line 3.
-# Returns [home_repo, home_subdir] if found; home_subdir may be None;
+# Returns (home_repo, home_subdir) if found; home_subdir may be None;
 # return None if no repo name is recognized.
 def _check_for_home_info(filepath):
-  global _cached_info_by_path, _repos
-  st = os.stat(filepath)
-  st_times = (st.st_ctime, st.st_mtime)
-  if filepath in _cached_info_by_path:
-    info = _cached_info_by_path[filepath]
-    if st_times == info['times']:
-      home_info = info['home_info']
-      return home_info if home_info[0] else None
+  global _cached_info_by_dir, _repos
+  st = _stat(filepath, keep=False)
+  if st is None: raise OSError("Can't stat %s" % filepath)
+  fingerprint = _stat_fingerprint(st)
+  dir_path, base = os.path.split(filepath)
+  info_by_base = _cached_info_by_dir.setdefault(dir_path, {})
+  info = info_by_base.get(base)
+  if info is not None and fingerprint == info[2]:
+    _stats['header cache hits'] += 1
+    if info[3] != _run_time: info_by_base[base] = info[:3] + (_run_time,) + info[4:]
+    if info[0] is None: return None
+    _stat_by_path[filepath] = st  # Files with a home repo will be compared, so keep their stat.
+    return info[:2]
   # If we get here, then the cache didn't have the info; need to populate it.
-  info = {'home_info': [None, None], 'times': st_times}
-  _cached_info_by_path[filepath] = info
+  _stats['header cache misses'] += 1
+  info_by_base[base] = (None, None, fingerprint, _run_time, None)
   with open(filepath, 'r') as f:
     try:
       file_start = f.read(4096)
@@ -660,19 +1420,106 @@ def _check_for_home_info(filepath):
     regex = _get_homeinfo_regex()
     m = regex.search(line3)
     if m is None: return None
-    home_info = [m.group(1), m.group(2)]
-    info['home_info'] = home_info
+    home_info = (_intern(m.group(1)), _intern(m.group(2)))
+    info_by_base[base] = home_info + (fingerprint, _run_time, None)
+    _stat_by_path[filepath] = st  # Files with a home repo will be compared, so keep their stat.
     return home_info
 
+# Returns the os.stat result for path, or None if it can't be stat'ed. Results are kept for the
+# rest of the run, except that syncer's own copies and deletes forget the results for their paths.
+# If keep is False, a new result isn't kept; this is for paths that are stat'ed once per walk.
+def _stat(path, keep=True):
+  _stats['file stats requested'] += 1
+  if path in _stat_by_path: return _stat_by_path[path]
+  _stats['file stats made'] += 1
+  try:
+    st = os.stat(path)
+  except OSError:
+    st = None
+  if keep: _stat_by_path[path] = st
+  return st
+
+def _forget_stat(path):
+  _stat_by_path.pop(path, None)
+
+def _isfile(path):
+  st = _stat(path)
+  return st is not None and stat.S_ISREG(st.st_mode)
+
+def _isdir(path):
+  st = _stat(path)
+  return st is not None and stat.S_ISDIR(st.st_mode)
+
+def _getmtime(path):
+  return _stat(path).st_mtime
+
+# Returns a tuple of integers that changes whenever the file's contents may have changed.
+def _stat_fingerprint(st):
+  return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+
+# Returns the hex digest of the file at path, using and updating the digest in the path's cached
+# info when the file's fingerprint still matches that entry.
+def _file_digest(path):
+  dir_path, base = os.path.split(path)
+  info = _cached_info_by_dir.get(dir_path, {}).get(base)
+  is_cached = (info is not None and info[2] == _stat_fingerprint(_stat(path)))
+  if is_cached and info[4]: return info[4]
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), b''): h.update(block)
+  digest = h.hexdigest()
+  if is_cached: _cached_info_by_dir[dir_path][base] = info[:4] + (digest,)
+  return digest
+
+# Drops cached info for every file not seen during this run; this is meant to be called after a
+# full scan of all tracked repos, so that deleted files and untracked repos leave the cache.
+def _prune_cached_info():
+  global _cached_info_by_dir
+  for dir_path in list(_cached_info_by_dir):
+    info_by_base = _cached_info_by_dir[dir_path]
+    for base in [b for b, info in info_by_base.items() if info[3] != _run_time]:
+      del info_by_base[base]
+    if len(info_by_base) == 0: del _cached_info_by_dir[dir_path]
+
+# Evicts the least recently seen entries until at most _max_cached_info_entries remain.
+def _limit_cached_info_size():
+  global _cached_info_by_dir
+  num_entries = sum([len(info_by_base) for info_by_base in _cached_info_by_dir.values()])
+  num_to_evict = num_entries - _max_cached_info_entries
+  if num_to_evict <= 0: return
+  entries = [(info[3], dir_path, base)
+             for dir_path, info_by_base in _cached_info_by_dir.items()
+             for base, info in info_by_base.items()]
+  for _, dir_path, base in heapq.nsmallest(num_to_evict, entries):
+    info_by_base = _cached_info_by_dir[dir_path]
+    del info_by_base[base]
+    if len(info_by_base) == 0: del _cached_info_by_dir[dir_path]
+
+def _show_stats():
+  print('Statistics:')
+  for name, count in _stats.items(): print('  %s: %d' % (name, count))
+
+def _set_cache_size(cache_size):
+  global _max_cached_info_entries
+  if cache_size < 0:
+    print('Error: --cache-size must be nonnegative.')
+    exit(2)
+  _max_cached_info_entries = cache_size
+
+# Returns the canonical copy of the string s, or None if s is None. Repo names, subdirs and paths
+# repeat across many cache entries and connections; interning them stores each distinct one once.
+def _intern(s):
+  return None if s is None else sys.intern(s)
+
 # A cache to avoid redundant os.walk calls.
-# _subpaths_of_root[root][base] = [(path, subpath)]
+# _subpaths_of_root[root][base] = [(dir_path, subpath)]
+# The dir_path and subpath strings are shared by all files in a directory.
 # This is used in _get_all_subpaths.
 _subpaths_of_root = {}
 
 def _should_skip_dir(dirname):
   return dirname == '.git'
 
-# For the convenience of _find_home_path, all subpath tuples are of the form (path, subpath, True).
 def _get_all_subpaths(root):
   global _subpaths_of_root
   if root in _subpaths_of_root: return _subpaths_of_root[root]
@@ -680,49 +1527,92 @@ def _get_all_subpaths(root):
   for path, dirs, files in os.walk(root):
     dirs[:] = [d for d in dirs if not _should_skip_dir(d)]
     subpath = path[len(root) + 1:]
-    for f in files: subpaths.setdefault(f, []).append((path + os.sep + f, subpath, True))
+    for f in files: subpaths.setdefault(f, []).append((path, subpath))
   _subpaths_of_root[root] = subpaths
   return subpaths
 
+# A path trie is a nested dict keyed by path component, so that finding every stored path that is
+# a prefix of a given path costs time proportional to that path's depth. The values stored at a
+# path are kept in a list under the None key of its node.
+def _trie_add(trie, path, value):
+  node = trie
+  for part in path.split(os.sep):
+    node = node.setdefault(part, {})
+  node.setdefault(None, []).append(value)
+
+def _trie_remove(trie, path, value):
+  node = trie
+  for part in path.split(os.sep):
+    node = node.get(part)
+    if node is None: return
+  node[None] = [v for v in node.get(None, []) if v is not value]
+
+# Yields the values stored at path and at each of its ancestors, shallowest first.
+def _trie_values_along(trie, path):
+  node = trie
+  for part in path.split(os.sep):
+    node = node.get(part)
+    if node is None: return
+    if None in node: yield from node[None]
+
+# Adds copy_info to _copy_dirs and to the path tries that index it.
+def _add_copy_dir(home_name, copy_info):
+  global _copy_dirs, _copy_infos_by_home_dir, _copy_infos_by_copy_dir
+  _copy_dirs.setdefault(home_name, {})[copy_info['copy_path']] = copy_info
+  _trie_add(_copy_infos_by_home_dir.setdefault(home_name, {}), copy_info['home_path'], copy_info)
+  _trie_add(_copy_infos_by_copy_dir.setdefault(home_name, {}), copy_info['copy_path'], copy_info)
+  copy_info['excluded_index'] = {}
+  for rel_path in copy_info['excluded']: _trie_add(copy_info['excluded_index'], rel_path, True)
+
+def _exclude_rel_path(copy_info, rel_path):
+  copy_info['excluded'].add(rel_path)
+  _trie_add(copy_info['excluded_index'], rel_path, True)
+
 # This expects path to be a relative path.
 def _is_rel_path_excluded(path, copy_info):
-  head, tail = path, ''
-  while len(head) > 1:  # This may end when head == '/'.
-    if head in copy_info['excluded']:
-      return True
-    head, start_of_new_tail = os.path.split(head)
-    tail = os.path.join(start_of_new_tail, tail)
+  for _ in _trie_values_along(copy_info['excluded_index'], path): return True
   return False
 
 # This uses the directory tracking data to determine a (home_path, home_subpath) for the given
 # file's copy_path. This returns None, None if no home_path could be found.
 def _get_tracked_home_path(copy_path, home_name):
-  if home_name not in _copy_dirs: return None, None
-  copy_info_of_copy_path = _copy_dirs[home_name]
-  head, tail = os.path.split(copy_path)
-  while len(head) > 1:  # We end when head == '/'.
-    if head not in copy_info_of_copy_path:
-      head, start_of_new_tail = os.path.split(head)
-      tail = os.path.join(start_of_new_tail, tail)
-      continue
-    copy_info = copy_info_of_copy_path[head]
-    if _is_rel_path_excluded(tail, copy_info):
-      return None, None
-    home_dir_head = copy_info['home_path']
-    home_root     = copy_info['home_root']
-    home_path     = os.path.join(home_dir_head, tail)
-    home_subpath  = os.path.dirname(home_path[len(home_root) + 1:])
-    return home_path, home_subpath
-  return None, None  # No tracking copy_info exists for this copy_path.
+  if home_name not in _copy_infos_by_copy_dir: return None, None
+  # The innermost copy dir containing copy_path is the one that determines its home path.
+  copy_info = None
+  for copy_info in _trie_values_along(_copy_infos_by_copy_dir[home_name],
+                                      os.path.dirname(copy_path)):
+    pass
+  if copy_info is None: return None, None  # No tracking copy_info exists for this copy_path.
+  tail = copy_path[len(copy_info['copy_path']) + 1:]
+  if _is_rel_path_excluded(tail, copy_info):
+    return None, None
+  home_dir_head = copy_info['home_path']
+  home_root     = copy_info['home_root']
+  home_path     = os.path.join(home_dir_head, tail)
+  home_subpath  = os.path.dirname(home_path[len(home_root) + 1:])
+  return home_path, home_subpath
 
 # _known_home_paths[(home_repo, home_subdir, base)] = home_path
 # This is used in _find_home_path.
 _known_home_paths = {}
 
+# An index of home files -- files in the repo named on their own line 3 -- by size and digest, so
+# that a home file that has moved can be found without walking its repo; see _find_moved_home_path.
+# This is built from _cached_info_by_dir when first needed, and kept up to date by _index_home_file.
+# _home_paths_by_content[(size, digest)] = set(home_paths)
+_home_paths_by_content = None
+
+# Moved home files, each with the copy dirs holding a copy that's been paired with it at its new
+# path, so that it isn't also reported as missing from those copy dirs.
+# _copy_dirs_of_moved_path[moved_home_path] = set(copy_dir_paths)
+_copy_dirs_of_moved_path = {}
+
 # Takes a [home_repo, home_subdir] pair as returned from _check_for_home_info, and attempts to
 # return a (home_path, home_subpath, was_found) tuple. Emits a warning if multiple files match the
 # given home_info. The value of home_subpath is as in:
 #   <home_path> = <home_root> <home_subpath> <filename>.
+# A home file that has moved is found with _find_moved_home_path; was_found is False in that case,
+# since the file isn't where its line 3 or copy dir says it is.
 def _find_home_path(home_info, filepath):
   global _repos, _known_home_paths
   for name, root in _repos:
@@ -735,14 +1625,32 @@ def _find_home_path(home_info, filepath):
     return _known_home_paths[key]
   if home_info[1]:
     home_path = os.path.join(home_root, home_info[1], base)
-    if not os.path.isfile(home_path):
-      return home_path, home_info[1], False  # False indicates that the home file wasn't found.
+    home_subpath = home_info[1]
+    if not _isfile(home_path):
+      moved_path = _find_moved_home_path(home_path, filepath, home_root)
+      if moved_path is None:
+        return home_path, home_info[1], False  # False indicates that the home file wasn't found.
+      _note_copy_of_moved_path(moved_path, filepath, home_info[0])
+      val = (moved_path, os.path.dirname(moved_path[len(home_root) + 1:]), False)
+      _known_home_paths[key] = val
+      return val
     val = (home_path, home_info[1], True)
     _known_home_paths[key] = val
     return val
   home_path, home_subpath = _get_tracked_home_path(filepath, home_info[0])
   if home_path:
-    val = (home_path, home_subpath, os.path.isfile(home_path))
+    val = (home_path, home_subpath, _isfile(home_path))
+    if not val[2]:
+      moved_path = _find_moved_home_path(home_path, filepath, home_root)
+      if moved_path:
+        _note_home_move(_innermost_copy_info(filepath, home_info[0]), home_path, moved_path)
+        _note_copy_of_moved_path(moved_path, filepath, home_info[0])
+        val = (moved_path, os.path.dirname(moved_path[len(home_root) + 1:]), False)
+    _known_home_paths[key] = val
+    return val
+  moved_path = _find_moved_home_path(None, filepath, home_root)
+  if moved_path:
+    val = (moved_path, os.path.dirname(moved_path[len(home_root) + 1:]), True)
     _known_home_paths[key] = val
     return val
   # Handle the case that no subdir was given; we must walk the dir to find it.
@@ -752,9 +1660,75 @@ def _find_home_path(home_info, filepath):
   basepaths = subpaths[base]
   if len(basepaths) > 1:
     print('Warning: found multiple home paths for %s, listed below:' % filepath)
-    for path in basepaths: print('    %s' % path)
-  _known_home_paths[key] = basepaths[0]
-  return basepaths[0]  # This is a (path, subpath, True) tuple.
+    for dir_path, _ in basepaths: print('    %s' % os.path.join(dir_path, base))
+  dir_path, home_subpath = basepaths[0]
+  val = (_intern(os.path.join(dir_path, base)), home_subpath, True)
+  _known_home_paths[key] = val
+  return val
+
+# Returns the path that the missing home file home_path has moved to within the repo at home_root,
+# or None. The home file index is searched for the size and digest last cached for home_path, and
+# then for the contents of its copy at copy_path; files with the same basename are preferred.
+# home_path may be None when only the copy is known.
+def _find_moved_home_path(home_path, copy_path, home_root):
+  home_paths_by_content = _get_home_paths_by_content()
+  keys = []
+  if home_path is not None:
+    dir_path, base = os.path.split(home_path)
+    info = _cached_info_by_dir.get(dir_path, {}).get(base)
+    if info is not None and info[4]: keys.append((info[2][2], info[4]))
+  if _isfile(copy_path): keys.append((_stat(copy_path).st_size, _file_digest(copy_path)))
+  base = os.path.basename(copy_path)
+  for key in keys:
+    paths = [path for path in home_paths_by_content.get(key, ())
+             if path != home_path and path.startswith(home_root + os.sep) and _isfile(path)]
+    if paths: return min(paths, key=lambda path: (os.path.basename(path) != base, path))
+  return None
+
+# Returns _home_paths_by_content, building it from the cached digests of home files if needed.
+def _get_home_paths_by_content():
+  global _home_paths_by_content
+  if _home_paths_by_content is not None: return _home_paths_by_content
+  _home_paths_by_content = {}
+  for dir_path, info_by_base in _cached_info_by_dir.items():
+    name, _ = _find_repo_of_path(dir_path + os.sep)
+    for base, info in info_by_base.items():
+      if info[0] is None or info[0] != name or not info[4]: continue
+      paths = _home_paths_by_content.setdefault((info[2][2], info[4]), set())
+      paths.add(_intern(os.path.join(dir_path, base)))
+  return _home_paths_by_content
+
+# Makes sure the home file at path has a cached digest, and adds it to _home_paths_by_content if
+# that's been built. The digest is only computed when the file's fingerprint has changed.
+def _index_home_file(path):
+  digest = _file_digest(path)
+  if _home_paths_by_content is None: return
+  _home_paths_by_content.setdefault((_stat(path).st_size, digest), set()).add(_intern(path))
+
+# Records that the copy at copy_path has been paired with the moved home file at moved_path.
+def _note_copy_of_moved_path(moved_path, copy_path, home_name):
+  copy_info = _innermost_copy_info(copy_path, home_name)
+  if copy_info is None: return
+  _copy_dirs_of_moved_path.setdefault(moved_path, set()).add(copy_info['copy_path'])
+
+# Updates copy_info after its home file old_path was found at new_path, if that's because the copy
+# dir's whole home dir has moved; that is, if the old home dir is gone and the file kept both its
+# path relative to that dir and the digest last cached for old_path.
+def _note_home_move(copy_info, old_path, new_path):
+  if copy_info is None or _isdir(copy_info['home_path']): return
+  tail = old_path[len(copy_info['home_path']) + 1:]
+  if not new_path.endswith(os.sep + tail): return
+  dir_path, base = os.path.split(old_path)
+  info = _cached_info_by_dir.get(dir_path, {}).get(base)
+  if info is None or info[4] != _file_digest(new_path): return
+  new_home_dir = new_path[:-len(tail) - 1]
+  print('Noticed that %s has moved to %s.' % (copy_info['home_path'], new_home_dir))
+  for home_name, copy_info_by_path in _copy_dirs.items():
+    if copy_info_by_path.get(copy_info['copy_path']) is not copy_info: continue
+    trie = _copy_infos_by_home_dir[home_name]
+    _trie_remove(trie, copy_info['home_path'], copy_info)
+    copy_info['home_path'] = new_home_dir
+    _trie_add(trie, new_home_dir, copy_info)
 
 # Internally compares the given files; "internally" means we don't show the user yet.
 # The results are stored in _diffs_by_home_path and _paths_by_basename.
@@ -762,22 +1736,77 @@ def _find_home_path(home_info, filepath):
 def _compare_full_paths(path1, path2, ignore_line3=False):
   # Turn this on if useful for debugging.
   if False: print('_compare_full_paths(%s, %s)' % (path0, path2))
-  if not os.path.isfile(path1) and not os.path.isfile(path2): return
-  _conns_by_path.setdefault(path1, set()).add((path1, path2, ignore_line3))
-  _conns_by_path.setdefault(path2, set()).add((path1, path2, ignore_line3))
+  if not _isfile(path1) and not _isfile(path2): return
+  path1, path2 = _intern(path1), _intern(path2)
+  _add_conn(path1, path2, ignore_line3)
   if _do_use_local_repo:
     # Since we're focused on the local repo, skip over pairs that don't affect it.
     if (not path1.startswith(_local_repo_path) and
         not path2.startswith(_local_repo_path)):
       return
   if _files_are_same(path1, path2, ignore_line3): return
-  _diffs_by_home_path.setdefault(path1, set()).add((path2, ignore_line3))
-  base = os.path.basename(path1)
-  _paths_by_basename.setdefault(base, set()).add(path1)
+  _add_diff(path1, path2, ignore_line3)
+
+# Records a difference in _diffs_by_home_path and _paths_by_basename; in --report mode, this also
+# prints the difference right away.
+def _add_diff(home_path, diff_path, ignore_line3):
+  global _num_reported_diffs
+  diffs = _diffs_by_home_path.setdefault(home_path, set())
+  if (diff_path, ignore_line3) in diffs: return
+  diffs.add((diff_path, ignore_line3))
+  _paths_by_basename.setdefault(os.path.basename(home_path), set()).add(home_path)
+  if _do_report:
+    if _num_reported_diffs == 0: print('Differences found:')
+    _num_reported_diffs += 1
+    cmp_str = _compare_paths_by_time(home_path, diff_path).strip()
+    print('  %s %s %s' % (home_path, cmp_str, diff_path), flush=True)
+
+# Records the connection between path1 and path2 in _conns_by_path without comparing the files.
+def _add_conn(path1, path2, ignore_line3=False):
+  conn = (path1, path2, ignore_line3)
+  _conns_by_path.setdefault(path1, set()).add(conn)
+  _conns_by_path.setdefault(path2, set()).add(conn)
+
+# Returns the group in _groups containing any of the given paths, or None.
+def _find_group(paths):
+  for group in _groups:
+    if any([path in group for path in paths]): return group
+  return None
+
+# Returns a digest of the file at path that ignores line 3.
+def _digest_without_line3(path):
+  lines = _lines_of_file(path)
+  return hashlib.sha1(''.join(lines[:2] + lines[3:]).encode('utf-8', 'surrogateescape')).digest()
+
+# Internally compares the members of a file group by reading each member once. Members are
+# bucketed by digest; if there's more than one bucket, the newest member is recorded as differing
+# from one member of each other bucket, and the remaining members go in _group_mates.
+def _compare_group(group):
+  paths = [_intern(path) for path in group if _isfile(path)]
+  for path in group:
+    if path not in paths: print('Warning: group member %s is not a file.' % path)
+  if len(paths) < 2: return
+  for path in paths[1:]: _add_conn(paths[0], path, True)
+  if _do_use_local_repo:
+    # Since we're focused on the local repo, skip over groups that don't affect it.
+    if not any([path.startswith(_local_repo_path) for path in paths]): return
+  paths_by_digest = {}
+  for path in paths: paths_by_digest.setdefault(_digest_without_line3(path), []).append(path)
+  if len(paths_by_digest) == 1: return
+  # Put the newest member of each bucket first, and find the newest member of all.
+  buckets = [sorted(bucket, key=_getmtime, reverse=True)
+             for bucket in paths_by_digest.values()]
+  buckets.sort(key=lambda bucket: _getmtime(bucket[0]), reverse=True)
+  newest = buckets[0][0]
+  for bucket in buckets:
+    _group_mates[bucket[0]] = bucket[1:]
+    if bucket[0] == newest: continue
+    _add_conn(newest, bucket[0], True)
+    _add_diff(newest, bucket[0], True)
 
 def _files_are_same(path1, path2, ignore_line3=False):
-  if not os.path.isfile(path1) or not os.path.isfile(path2): return False
-  if not ignore_line3: return filecmp.cmp(path1, path2)
+  if not _isfile(path1) or not _isfile(path2): return False
+  if not ignore_line3: return _file_contents_match(path1, path2)
   # We need to do more work to ignore line 3.
   lines = [None, None]
   paths = [path1, path2]
@@ -786,12 +1815,376 @@ def _files_are_same(path1, path2, ignore_line3=False):
     lines[i] = lines[i][:2] + lines[i][3:]  # Exclude line 3 (item [2] in a 0-indexed list).
   return lines[0] == lines[1]
 
+# Compares files the way filecmp.cmp does, but using _stat: files with the same type, size and
+# mtime are considered the same, and otherwise their contents are compared.
+def _file_contents_match(path1, path2):
+  st1, st2 = _stat(path1), _stat(path2)
+  if st1.st_size != st2.st_size: return False
+  if (stat.S_IFMT(st1.st_mode), st1.st_mtime) == (stat.S_IFMT(st2.st_mode), st2.st_mtime):
+    return True
+  with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+    while True:
+      block1, block2 = f1.read(1 << 16), f2.read(1 << 16)
+      if block1 != block2: return False
+      if not block1: return True
+
 def _lines_of_file(path):
   with open(path, 'r') as f:
     lines = f.readlines()
   return lines
 
 
+# plan functions
+# ==============
+
+# A plan is a list of (action, src, dst) steps, where action is one of _plan_actions. A delete step
+# has src == dst. Plans are saved as human-friendly text so they can be reviewed and edited.
+
+_default_plan_path = os.path.join(_config_path, 'plan')
+_plan_header = 'sync plan (copy|copy-keep-line3|add <src> -> <dst>, or delete <path>)'
+_plan_actions = ['copy', 'copy-keep-line3', 'add', 'delete']
+
+# Decides on a step for a single known difference, following the defaults suggested during
+# "syncer check": newer files are copied over older ones, and missing files are added.
+# Returns None when no safe default exists.
+def _plan_step_for_diff(home_path, copy_path, ignore_line3):
+  home_exists = _isfile(home_path)
+  copy_exists = _isfile(copy_path)
+  if home_exists and copy_exists:
+    home_is_older = (_getmtime(home_path) < _getmtime(copy_path))
+    oldpath, newpath = (home_path, copy_path) if home_is_older else (copy_path, home_path)
+    return ('copy-keep-line3' if ignore_line3 else 'copy', newpath, oldpath)
+  if ignore_line3: return None  # Line 3 can't be kept in a file that doesn't exist.
+  here_path, gone_path = (home_path, copy_path) if home_exists else (copy_path, home_path)
+  if gone_path == _unknown_home_path: return None
+  copy_info = _gone_file_metadata.get((here_path, gone_path))
+  if copy_info and not copy_info['tracking']: return None
+  return ('add', here_path, gone_path)
+
+# Returns the lines that step will leave at its dst. new_lines_by_path maps each file written by an
+# earlier step to its lines after that step; a src found there is read from the map, since the plan
+# will have changed it by the time this step runs.
+def _lines_after_step(step, new_lines_by_path):
+  action, src, dst = step
+  lines = list(new_lines_by_path[src]) if src in new_lines_by_path else _lines_of_file(src)
+  if action == 'copy-keep-line3': lines[2] = _lines_of_file(dst)[2]
+  return lines
+
+# Returns (steps, conflicts), where conflicts is a list of (path, [src_paths]) for files that would
+# receive different content from more than one newer file; those files are left out of the plan.
+# Steps include the transitive effects of each copy, found through _conns_by_path.
+def _make_plan():
+  direct_steps = []
+  for home_path in sorted(_diffs_by_home_path):
+    for copy_path, ignore_line3 in sorted(_diffs_by_home_path[home_path]):
+      step = _plan_step_for_diff(home_path, copy_path, ignore_line3)
+      if step: direct_steps.append(step)
+  # Find files that more than one newer file would be copied over.
+  srcs_by_dst = {}
+  for action, src, dst in direct_steps: srcs_by_dst.setdefault(dst, set()).add(src)
+  conflicts = [(dst, sorted(srcs)) for dst, srcs in sorted(srcs_by_dst.items()) if len(srcs) > 1]
+  # Transitive steps can also write different content to one file; the plan is then remade
+  # without that file, which may leave out steps that led to other conflicts.
+  while True:
+    steps, new_conflicts = _follow_plan_steps(direct_steps, set([dst for dst, _ in conflicts]))
+    if not new_conflicts: return steps, conflicts
+    conflicts = sorted(conflicts + new_conflicts)
+
+# Returns (steps, conflicts) for _make_plan: the direct steps whose dst isn't in conflicted,
+# followed by steps along the connections out from each written file, and a list of
+# (path, [src_paths]) for files that two of these steps would write with different content.
+def _follow_plan_steps(direct_steps, conflicted):
+  steps, new_lines_by_path, src_by_dst, srcs_by_conflict = [], {}, {}, {}
+  pending = [step for step in direct_steps if step[2] not in conflicted]
+  while pending:
+    step = pending.pop(0)
+    action, src, dst = step
+    new_lines = None if action == 'delete' else _lines_after_step(step, new_lines_by_path)
+    if dst in src_by_dst:
+      if new_lines != new_lines_by_path.get(dst):
+        srcs_by_conflict.setdefault(dst, set([src_by_dst[dst]])).add(src)
+      continue
+    steps.append(step)
+    src_by_dst[dst] = src
+    if action == 'delete': continue
+    new_lines_by_path[dst] = new_lines
+    # Group mates are connected like pairs that ignore line 3.
+    others = [(mate, True) for mate in _group_mates.get(dst, [])]
+    for home_path, copy_path, ignore_line3 in _conns_by_path.get(dst, ()):
+      others.append((copy_path if home_path == dst else home_path, ignore_line3))
+    for other, ignore_line3 in others:
+      if other in conflicted or other == src: continue
+      if other in new_lines_by_path:
+        other_lines = new_lines_by_path[other]  # A planned file is compared by its new content.
+      elif _isfile(other):
+        other_lines = _lines_of_file(other)
+      else:
+        if not ignore_line3: pending.append(('add', dst, other))
+        continue
+      if ignore_line3:
+        if new_lines[:2] + new_lines[3:] == other_lines[:2] + other_lines[3:]: continue
+        pending.append(('copy-keep-line3', dst, other))
+      else:
+        if new_lines == other_lines: continue
+        pending.append(('copy', dst, other))
+  return steps, [(dst, sorted(srcs)) for dst, srcs in sorted(srcs_by_conflict.items())]
+
+def _save_plan(plan_path, steps, conflicts):
+  with open(plan_path, 'w') as f:
+    f.write(_plan_header + '\n')
+    for action, src, dst in steps:
+      if action == 'delete': f.write('  delete %s\n' % dst)
+      else:                  f.write('  %s %s -> %s\n' % (action, src, dst))
+    for dst, srcs in conflicts:
+      f.write('# conflict: %s is older than each of these; resolve with "syncer check":\n' % dst)
+      for src in srcs: f.write('#   %s\n' % src)
+
+def _load_plan(plan_path):
+  steps = []
+  with open(plan_path, 'r') as f:
+    for line in f:
+      if len(line.strip()) == 0 or line.startswith('#') or line.startswith(_plan_header): continue
+      m = re.match(r'  (\S+) (\S.*) -> (\S.*)$', line.rstrip('\n'))
+      if m and m.group(1) in _plan_actions and m.group(1) != 'delete':
+        steps.append(m.groups())
+        continue
+      m = re.match(r'  delete (\S.*)$', line.rstrip('\n'))
+      if m:
+        steps.append(('delete', m.group(1), m.group(1)))
+        continue
+      print('Error: unable to parse the following line from %s' % plan_path)
+      print(line)
+      exit(1)
+  return steps
+
+# Splits steps into waves so that each step runs after the step that writes its src, if any.
+# Steps within a wave touch distinct files and may run in parallel.
+def _order_plan_steps(steps):
+  step_by_dst = {}
+  for step in steps:
+    if step[2] in step_by_dst:
+      print('Error: the plan changes %s more than once.' % step[2])
+      exit(1)
+    step_by_dst[step[2]] = step
+  wave_of_dst = {}
+  def find_wave(step, depth=0):
+    action, src, dst = step
+    if dst in wave_of_dst: return wave_of_dst[dst]
+    if depth > len(steps):
+      print('Error: the plan has a cycle of copies through %s.' % dst)
+      exit(1)
+    src_step = step_by_dst.get(src) if action != 'delete' else None
+    wave = 0 if src_step is None else find_wave(src_step, depth + 1) + 1
+    wave_of_dst[dst] = wave
+    return wave
+  waves = []
+  for step in steps:
+    wave = find_wave(step)
+    while len(waves) <= wave: waves.append([])
+    waves[wave].append(step)
+  return waves
+
+# Runs a single step after saving a backup of its dst in backup_dir.
+# Returns an undo record of the form (dst, backup_path), where backup_path is None if dst was new.
+def _run_plan_step(step, backup_dir, index):
+  action, src, dst = step
+  backup_path = None
+  if _isfile(dst):
+    backup_path = os.path.join(backup_dir, str(index))
+    shutil.copy2(dst, backup_path)
+  elif action != 'add':
+    raise FileNotFoundError('%s does not exist' % dst)
+  try:
+    if action == 'delete':
+      os.remove(dst)
+      _forget_stat(dst)
+    else:
+      _copy_src_to_dst(src, dst, preserve_line3=(action == 'copy-keep-line3'))
+  except:
+    _undo_plan_steps([(dst, backup_path)])  # Don't leave a partially written dst behind.
+    raise
+  return (dst, backup_path)
+
+# Restores every dst from the given undo records, most recent first.
+# Directories created by add steps are left in place.
+def _undo_plan_steps(undo_records):
+  for dst, backup_path in reversed(undo_records):
+    if backup_path:
+      shutil.copy2(backup_path, dst)
+    else:
+      try:
+        os.remove(dst)
+      except FileNotFoundError:
+        pass  # The add step failed before writing dst.
+    _forget_stat(dst)
+
+# Runs each wave of steps with a thread pool; if any step fails, all completed steps are undone.
+def _run_plan(waves):
+  undo_records = []
+  with tempfile.TemporaryDirectory(prefix='syncer_apply_') as backup_dir:
+    index = 0
+    for wave in waves:
+      errors = []
+      with ThreadPoolExecutor() as pool:
+        futures = []
+        for step in wave:
+          futures.append((step, pool.submit(_run_plan_step, step, backup_dir, index)))
+          index += 1
+        for step, future in futures:
+          try:
+            undo_records.append(future.result())
+          except Exception as e:
+            errors.append((step, e))
+      if errors:
+        for (action, src, dst), e in errors:
+          print('Error: unable to %s %s: %s' % (action, dst, e))
+        _undo_plan_steps(undo_records)
+        print('All changes from this plan have been undone.')
+        exit(1)
+
+
+# duplicate-finding functions
+# ===========================
+
+# Files are first bucketed by size; only files that share a size are read. Those are compared by a
+# partial digest of their first and last _partial_digest_bytes bytes, and files that still match
+# are compared by a full digest. Files no longer than twice _partial_digest_bytes go straight to the
+# full digest, which costs them the same read and is kept in the header cache for later runs.
+_partial_digest_bytes = 4096
+
+# Same-basename files whose sizes differ by at most this many bytes are compared apart from their
+# 3rd lines, to find copies that only differ in their line-3 markers.
+_max_line3_size_diff = 256
+
+# Yields a (size, path) pair for each untracked file in the tracked repos. A file is tracked if it
+# has a line-3 marker, is in a custom pair or group, or is within a tracked copy dir. Files are
+# found with the header cache, so an unchanged file is only stat'ed. Empty files are skipped.
+def _find_untracked_files():
+  paths_in_pairs = set([path for pair in _pairs for path in pair])
+  paths_in_pairs.update([path for group in _groups for path in group])
+  done_dirs = set()  # A nested repo's dirs are walked for each repo containing them.
+  for name, dir_path, files in _walk_repo_dirs():
+    if dir_path in done_dirs: continue
+    done_dirs.add(dir_path)
+    for filename in files:
+      path = os.path.join(dir_path, filename)
+      try:
+        if _check_for_home_info(path) is not None: continue
+      except OSError:
+        continue  # The file may be a broken link, or unreadable.
+      size = _cached_info_by_dir[dir_path][filename][2][2]
+      if size == 0 or path in paths_in_pairs or _is_in_tracked_copy_dir(path): continue
+      yield size, path
+
+def _is_in_tracked_copy_dir(path):
+  for copy_infos_by_copy_dir in _copy_infos_by_copy_dir.values():
+    for copy_info in _trie_values_along(copy_infos_by_copy_dir, os.path.dirname(path)):
+      if not copy_info['tracking']: continue
+      if not _is_rel_path_excluded(path[len(copy_info['copy_path']) + 1:], copy_info): return True
+  return False
+
+# Returns a digest of the start and end of the file at path, which has the given size.
+def _partial_file_digest(path, size):
+  with open(path, 'rb') as f:
+    h = hashlib.sha1(f.read(_partial_digest_bytes))
+    f.seek(size - _partial_digest_bytes)
+    h.update(f.read(_partial_digest_bytes))
+  return h.hexdigest()
+
+# Splits the given paths into lists of paths whose results from digest_fn match, dropping paths
+# whose digest can't be computed and lists with only one path.
+def _bucket_paths_by(paths, digest_fn):
+  paths_by_digest = {}
+  for path in paths:
+    try:
+      digest = digest_fn(path)
+    except (OSError, UnicodeDecodeError):
+      continue
+    paths_by_digest.setdefault(digest, []).append(path)
+  return [bucket for bucket in paths_by_digest.values() if len(bucket) > 1]
+
+# Returns a list of lists of identical files from a {size: [paths]} dict.
+def _find_identical_files(paths_by_size):
+  identical = []
+  for size, paths in paths_by_size.items():
+    if len(paths) < 2: continue
+    if size <= 2 * _partial_digest_bytes:
+      identical.extend(_bucket_paths_by(paths, _file_digest))
+      continue
+    for bucket in _bucket_paths_by(paths, lambda path: _partial_file_digest(path, size)):
+      identical.extend(_bucket_paths_by(bucket, _file_digest))
+  return identical
+
+# Returns lists of same-basename files that match apart from line 3, given the sizes of all the
+# files and the lists of identical files. Each list has files from at least two sets of identical
+# files, where a set may be a single file, and sets are kept whole.
+def _find_files_same_but_line3(size_by_path, identical):
+  # Each identical set is represented by its first path.
+  set_of_path = {path: [path] for path in size_by_path}
+  for paths in identical:
+    for path in paths: set_of_path[path] = paths
+  reps_by_base = {}
+  for path, paths in set_of_path.items():
+    if path == paths[0]: reps_by_base.setdefault(os.path.basename(path), []).append(path)
+  near = []
+  for base, reps in reps_by_base.items():
+    if len(reps) < 2: continue
+    reps.sort(key=size_by_path.get)
+    candidates = set()
+    for rep1, rep2 in zip(reps, reps[1:]):
+      if size_by_path[rep2] - size_by_path[rep1] <= _max_line3_size_diff:
+        candidates.update([rep1, rep2])
+    for bucket in _bucket_paths_by(sorted(candidates), _digest_without_line3):
+      near.append([path for rep in bucket for path in set_of_path[rep]])
+  return near
+
+# Returns True if the file at path can be tracked. Tracked files are read as text, and paths are
+# separated by spaces in the file_connections config file.
+def _can_be_tracked(path):
+  if any([c.isspace() for c in path]): return False
+  try:
+    _lines_of_file(path)
+  except (OSError, UnicodeDecodeError):
+    return False
+  return True
+
+# Prints a "syncer track" line for each group of untracked same-basename files that are identical,
+# or identical apart from line 3; a "#" comment line before each one describes the group. Files
+# that can't be tracked are left out of the groups and listed in a final comment.
+def _find_duplicates(action_args):
+  if len(action_args) > 0:
+    print('Warning: ignoring the extra arguments %s' % ' '.join(action_args))
+  paths_by_size, size_by_path = {}, {}
+  for size, path in _find_untracked_files():
+    paths_by_size.setdefault(size, []).append(path)
+    size_by_path[path] = size
+  # Identical files can only be tracked together if their basenames match.
+  identical = []
+  for paths in _find_identical_files(paths_by_size):
+    paths_by_base = {}
+    for path in paths: paths_by_base.setdefault(os.path.basename(path), []).append(path)
+    identical.extend([bucket for bucket in paths_by_base.values() if len(bucket) > 1])
+  near = _find_files_same_but_line3(size_by_path, identical)
+  in_near = set([path for paths in near for path in paths])
+  groups = [(sorted(paths), 'identical') for paths in identical if paths[0] not in in_near]
+  groups += [(sorted(paths), 'the same apart from line 3') for paths in near]
+  trackable_groups, untrackable = [], []
+  for paths, how in groups:
+    trackable = [path for path in paths if _can_be_tracked(path)]
+    untrackable.extend([path for path in paths if path not in trackable])
+    if len(trackable) > 1: trackable_groups.append((trackable, how))
+  if not groups:
+    print('No untracked duplicate files found.')
+    return
+  for paths, how in sorted(trackable_groups):
+    print('# %d files are %s:' % (len(paths), how))
+    print('syncer track %s' % ' '.join([shlex.quote(path) for path in paths]))
+  if untrackable:
+    print('# These duplicates can\'t be tracked, as syncer only tracks text files with no spaces')
+    print('# in their paths:')
+    for path in sorted(untrackable): print('#   %s' % path)
+
+
 # config file functions
 # =====================
 
@@ -806,6 +2199,8 @@ def _load_file_connections():
         adding_to = _repos
       elif line.startswith(_pairs_header):
         adding_to = _pairs
+      elif line.startswith(_groups_header):
+        adding_to = _groups
       elif adding_to is not None:
         adding_to.append(line.strip().split(' '))
 
@@ -824,29 +2219,51 @@ def _load_changed_paths():
         else: _changed_paths.setdefault(changed_paths_key, []).append(line.strip())
 
 def _load_cached_info():
-  global _cached_info_by_path
+  global _cached_info_by_dir
   file_path = os.path.join(_config_path, 'cached_info')
   if not os.path.isfile(file_path): return
   with open(file_path, 'r') as f:
-    adding_to = None
+    is_adding = False
     for line in f:
       if len(line.strip()) == 0: continue
       if line.startswith(_cached_info_header):
-        adding_to = _cached_info_by_path
-      elif adding_to == _cached_info_by_path:
+        is_adding = True
+      elif is_adding:
         m = re.match(r'  \S.*', line)  # All non-paths start with a space.
         line = line.strip()
         if m:
-          path = m.group(0).lstrip()
-          key = 'home_info'
+          dir_path, base = os.path.split(m.group(0).lstrip())
+          info_by_base = _cached_info_by_dir.setdefault(dir_path, {})
+          home_info = []
+        elif len(home_info) < 2:
+          # The [1:] here ignores the initial : character on non-None string values.
+          home_info.append(_intern(line[1:]) if line != 'None' else None)
+        elif line.startswith('seen '):
+          info_by_base[base] = info_by_base[base][:3] + (int(line[5:]),) + info_by_base[base][4:]
+        elif line.startswith('digest '):
+          info_by_base[base] = info_by_base[base][:4] + (line[7:],)
         else:
-          info = _cached_info_by_path.setdefault(path, {})
-          if key == 'home_info':
-            # The [1:] here ignores the initial : character on non-None string values.
-            info.setdefault(key, []).append(line[1:] if line != 'None' else None)
-            if len(info[key]) == 2: key = 'times'
-          else:
-            info[key] = tuple([int(t) for t in line.split(' ')])
+          # Entries saved before fingerprints existed hold two whole-second times; those never
+          # match a fingerprint, so such files are re-read once.
+          fingerprint = tuple([int(t) for t in line.split(' ')])
+          # A seen value of 0 is used for entries saved before seen values existed.
+          info_by_base[base] = tuple(home_info) + (fingerprint, 0, None)
+
+# Returns (num_files, dir_paths) as saved by _save_dir_recency, where dir_paths is an iterator that
+# reads the ranked dirs from the file as they're needed; this is (0, an empty iterator) if none are
+# saved.
+def _load_dir_recency():
+  file_path = os.path.join(_config_path, 'dir_recency')
+  if not os.path.isfile(file_path): return 0, iter(())
+  f = open(file_path, 'r')
+  if f.readline().rstrip('\n') != _dir_recency_header:
+    f.close()
+    return 0, iter(())
+  num_files = int(f.readline())
+  def dir_paths():
+    with f:
+      for line in f: yield line[4:].rstrip('\n')
+  return num_files, dir_paths()
 
 def _load_copy_dirs():
   global _copy_dirs
@@ -856,9 +2273,8 @@ def _load_copy_dirs():
   copy_path = None
   copy_info = {'excluded': set()}
   def save_copy_info_if_needed(home_name, copy_path, copy_info):
-    global _copy_dirs
     if 'home_path' not in copy_info: return copy_info
-    _copy_dirs.setdefault(home_name, {})[copy_path] = copy_info
+    _add_copy_dir(home_name, copy_info)
     return {'excluded': set(),
             'home_root': copy_info['home_root'],
             'copy_path': copy_path}
@@ -913,6 +2329,9 @@ def _save_file_connections():
     if _pairs:
       f.write('%s:\n' % _pairs_header)
       for pair in _pairs: f.write('  %s %s\n' % tuple(pair))
+    if _groups:
+      f.write('%s:\n' % _groups_header)
+      for group in _groups: f.write('  %s\n' % ' '.join(group))
 
 def _save_changed_paths():
   file_path = os.path.join(_config_path, 'changed_paths')
@@ -925,16 +2344,52 @@ def _save_changed_paths():
           f.write('    %s\n' % path)
 
 def _save_cached_info():
-  global _cached_info_by_path
+  global _cached_info_by_dir
+  _limit_cached_info_size()
   file_path = os.path.join(_config_path, 'cached_info')
   with open(file_path, 'w') as f:
     f.write(_cached_info_header + '\n')
-    for path, info in _cached_info_by_path.items():
-      f.write('  %s\n' % path)
-      for i in range(2):
-        item = info['home_info'][i]
-        f.write('    %s\n' % ((':' + item) if item else 'None'))
-      f.write('    %d %d\n' % info['times'])
+    for dir_path, info_by_base in _cached_info_by_dir.items():
+      for base, info in info_by_base.items():
+        f.write('  %s\n' % os.path.join(dir_path, base))
+        for item in info[:2]:
+          f.write('    %s\n' % ((':' + item) if item else 'None'))
+        f.write('    %s\n' % ' '.join([str(n) for n in info[2]]))
+        f.write('    seen %d\n' % info[3])
+        if info[4]: f.write('    digest %s\n' % info[4])
+
+# Saves the dirs of cached files, ranked by their newest cached mtime; a home dir's mirroring copy
+# dirs are ranked with it. This is done with the cache so that a budgeted check needn't do it.
+def _save_dir_recency():
+  priority_of_dir = {}
+  for dir_path, info_by_base in _cached_info_by_dir.items():
+    if not info_by_base: continue
+    priority = max([info[2][0] for info in info_by_base.values()])
+    for path in [dir_path] + _mirroring_copy_dirs(dir_path):
+      if priority > priority_of_dir.get(path, -1): priority_of_dir[path] = priority
+  num_files = sum([len(info_by_base) for info_by_base in _cached_info_by_dir.values()])
+  with open(os.path.join(_config_path, 'dir_recency'), 'w') as f:
+    f.write(_dir_recency_header + '\n')
+    f.write('  %d\n' % num_files)
+    for dir_path in sorted(priority_of_dir, key=priority_of_dir.get, reverse=True):
+      f.write('    %s\n' % dir_path)
+
+# Saves the pair index from a full walk, given the {dir_path: (mtime_ns, files digest)} of its dirs
+# and the file its pair lines were written to. The index is written to a temporary file that then
+# replaces the old index, so that an interrupted save never leaves a partial index that looks fresh.
+def _save_pair_index(dir_states, pairs_file):
+  file_path = os.path.join(_config_path, 'pair_index')
+  with tempfile.NamedTemporaryFile('w', dir=_config_path, prefix='pair_index.',
+                                   delete=False) as f:
+    f.write(_pair_index_header + '\n')
+    f.write('  config %s\n' % _pair_index_config_digest())
+    f.write('  dirs:\n')
+    for dir_path, (mtime_ns, files_digest) in dir_states.items():
+      f.write('    %d %s %s\n' % (mtime_ns, files_digest, json.dumps(dir_path)))
+    f.write('  pairs:\n')
+    pairs_file.seek(0)
+    shutil.copyfileobj(pairs_file, f)
+  os.replace(f.name, file_path)
 
 def _save_copy_dirs():
   global _copy_dirs
@@ -957,6 +2412,7 @@ def _save_config():
   _save_file_connections()
   _save_changed_paths()
   _save_cached_info()
+  _save_dir_recency()
   _save_copy_dirs()
 
 
@@ -0,0 +1,279 @@
+# test_syncer.py
+#
+# Tests that run syncer end to end on small workspaces in temporary directories.
+# Run with "python -m pytest" or "python -m unittest test_syncer".
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_syncer_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Each syncer run is a separate process, since syncer keeps its state in module globals. This
+# mirrors the __main__ block of syncer.py, minus the terminal setup in _init.
+_run_code = '''
+import sys, syncer
+syncer._handle_args(['syncer'] + sys.argv[1:])
+syncer._save_config()
+'''
+
+
+class SyncerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.home = os.path.join(self.root, 'home')
+    os.mkdir(self.home)
+    self.mtime = 1000000000
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  # Returns the absolute path of rel_path within the workspace.
+  def path(self, rel_path):
+    return os.path.join(self.root, rel_path)
+
+  # Writes a C-style file whose 3rd line names home_repo, if given. Each write gets a later mtime.
+  def write(self, rel_path, body, home_repo=None, line3=None):
+    path = self.path(rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if line3 is None: line3 = '// Home repo: %s' % home_repo if home_repo else '//'
+    with open(path, 'w') as f:
+      f.write('// %s\n//\n%s\n%s\n' % (os.path.basename(path), line3, body))
+    self.mtime += 10
+    os.utime(path, (self.mtime, self.mtime))
+    return path
+
+  def read(self, rel_path):
+    with open(self.path(rel_path)) as f:
+      return f.read()
+
+  # Runs syncer from the workspace dir cwd and returns (exit status, stdout).
+  def syncer(self, cwd, *args):
+    env = dict(os.environ, HOME=self.home, PYTHONPATH=_syncer_dir)
+    result = subprocess.run([sys.executable, '-c', _run_code] + list(args),
+                            cwd=self.path(cwd), env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    return result.returncode, result.stdout
+
+  # Runs syncer.py as a script, as a shell or git hook would, from the workspace dir cwd and with
+  # stdin_text, or else /dev/null, as stdin. Returns (exit status, stdout).
+  def run_script(self, cwd, *args, stdin_text=None):
+    env = dict(os.environ, HOME=self.home)
+    stdin = subprocess.DEVNULL if stdin_text is None else None
+    result = subprocess.run([sys.executable, os.path.join(_syncer_dir, 'syncer.py')] + list(args),
+                            cwd=self.path(cwd), env=env, stdin=stdin, input=stdin_text,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    return result.returncode, result.stdout
+
+  def assert_syncer(self, cwd, *args, status=0):
+    returncode, output = self.syncer(cwd, *args)
+    self.assertEqual(returncode, status, output)
+    return output
+
+  def track_repos(self, *names):
+    for name in names:
+      os.makedirs(self.path(name), exist_ok=True)
+      self.assert_syncer(name, 'track', name)
+
+
+class PlanTest(SyncerTest):
+
+  # libA/src/x.h is copied into appB/vendor and appC/vendor, and appC's copy is paired with
+  # plat/x.h. An edit to appB's copy should reach plat/x.h, two connections away from libA.
+  def setUp(self):
+    super().setUp()
+    self.write('libA/src/x.h', 'int x;', home_repo='libA')
+    self.write('appB/vendor/x.h', 'int x;', home_repo='libA')
+    self.write('appC/vendor/x.h', 'int x;', home_repo='libA')
+    self.write('plat/x.h', 'int x;', line3='// plat')
+    self.track_repos('libA', 'appB', 'appC')
+    self.assert_syncer('.', 'track', self.path('appC/vendor/x.h'), self.path('plat/x.h'))
+    self.assert_syncer('.', 'check', '--all', '--report')
+
+  def test_plan_follows_copies_transitively(self):
+    self.write('appB/vendor/x.h', 'int x, y;', home_repo='libA')
+    self.assert_syncer('.', 'plan', '--all')
+    self.assert_syncer('.', 'apply')
+    for rel_path in ['libA/src/x.h', 'appC/vendor/x.h', 'plat/x.h']:
+      self.assertIn('int x, y;', self.read(rel_path))
+    self.assertIn('// plat\n', self.read('plat/x.h'))
+    self.assert_syncer('.', 'check', '--all', '--report')
+
+  # plat/x.h reaches libA/src/x.h through appC/vendor/x.h, and appB/vendor/x.h reaches it directly,
+  # with different content, so neither may be copied over it.
+  def test_transitive_conflict_is_left_out(self):
+    self.write('plat/x.h', 'int x, p;', line3='// plat')
+    self.write('appB/vendor/x.h', 'int x, b;', home_repo='libA')
+    before = self.read('libA/src/x.h')
+    self.assert_syncer('.', 'plan', '--all')
+    with open(os.path.join(self.home, '.syncer', 'plan')) as f:
+      plan = f.read()
+    self.assertIn('# conflict: %s is older' % self.path('libA/src/x.h'), plan)
+    self.assertNotIn('-> %s' % self.path('libA/src/x.h'), plan)
+    self.assert_syncer('.', 'apply')
+    self.assertEqual(self.read('libA/src/x.h'), before)
+    self.assertIn('int x, p;', self.read('plat/x.h'))
+
+  def test_failed_apply_undoes_every_step(self):
+    self.write('appB/vendor/x.h', 'int x, y;', home_repo='libA')
+    self.assert_syncer('.', 'plan', '--all')
+    before = self.read('libA/src/x.h')
+    with open(os.path.join(self.home, '.syncer', 'plan'), 'a') as f:
+      f.write('  copy %s -> %s\n' % (self.path('missing/y.h'), self.path('plat/y.h')))
+    output = self.assert_syncer('.', 'apply', status=1)
+    self.assertIn('have been undone', output)
+    self.assertEqual(self.read('libA/src/x.h'), before)
+    self.assertFalse(os.path.exists(self.path('plat/y.h')))
+
+
+class ListTest(SyncerTest):
+
+  # appB/other/gone.h names libA as its home repo, but libA has no such file and appB/other isn't a
+  # known copy dir, so its pair has the unknown home path, which has spaces in it.
+  def setUp(self):
+    super().setUp()
+    self.write('libA/src/x.h', 'int x;', home_repo='libA')
+    self.write('appB/vendor/x.h', 'int x;', home_repo='libA')
+    self.write('appB/other/gone.h', 'int gone;', home_repo='libA')
+    self.track_repos('libA', 'appB')
+
+  def test_list_reads_back_its_pair_index(self):
+    first = self.assert_syncer('.', 'list', '--format', 'json')
+    second = self.assert_syncer('.', 'list', '--format', 'json')
+    self.assertIn('(unknown home path)', first)
+    self.assertEqual(first, second)
+    # The index saved by a full check walk has to read back as well.
+    self.assert_syncer('.', 'check', '--all', '--report', status=1)
+    self.assertIn('appB/other/gone.h', self.assert_syncer('.', 'list', '--format', 'json'))
+
+  # Each header read follows a stat of its file, and --stats has to count those, too.
+  def test_stats_count_every_stat(self):
+    output = self.assert_syncer('.', 'list', '--stats')
+    stats = dict([line.strip().rsplit(': ', 1) for line in output.split('\n') if ': ' in line])
+    self.assertEqual(stats['header cache misses'], '3')
+    self.assertGreaterEqual(int(stats['file stats made']), 3 + 5)  # 3 files, 5 dirs.
+
+  # Adding a 3rd-line marker to existing files changes their pairs, but not their dirs' mtimes.
+  def test_list_sees_files_edited_in_place(self):
+    self.write('libA/src/y.h', 'int y;')
+    self.write('appB/vendor/y.h', 'int y;')
+    self.assertNotIn('y.h', self.assert_syncer('.', 'list'))
+    dir_mtimes = [os.stat(self.path(d)).st_mtime_ns for d in ['libA/src', 'appB/vendor']]
+    self.write('libA/src/y.h', 'int y;', home_repo='libA')
+    self.write('appB/vendor/y.h', 'int y;', home_repo='libA')
+    self.assertEqual([os.stat(self.path(d)).st_mtime_ns for d in ['libA/src', 'appB/vendor']],
+                     dir_mtimes)
+    self.assertIn(self.path('appB/vendor/y.h'), self.assert_syncer('.', 'list'))
+
+
+class MoveTest(SyncerTest):
+
+  # libA/src/f1.h is copied into appB/vendor, then moved into libA/src/sub and touched.
+  def setUp(self):
+    super().setUp()
+    self.write('libA/src/f1.h', 'int f1;', home_repo='libA')
+    self.write('libA/src/f2.h', 'int f2;', home_repo='libA')
+    self.write('appB/vendor/f1.h', 'int f1;', home_repo='libA')
+    self.write('appB/vendor/f2.h', 'int f2;', home_repo='libA')
+    self.track_repos('libA', 'appB')
+    self.assert_syncer('.', 'check', '--all', '--report')
+    os.makedirs(self.path('libA/src/sub'))
+    os.rename(self.path('libA/src/f1.h'), self.path('libA/src/sub/f1.h'))
+    os.utime(self.path('libA/src/sub/f1.h'))
+
+  # The home repo is walked before the copy that reveals the move, so the home file's missing copy
+  # must not be reported before the whole scan is done.
+  def test_budgeted_check_recognizes_move(self):
+    output = self.assert_syncer('.', 'check', '--all', '--report', '--budget', '100000')
+    self.assertNotIn("doesn't exist", output)
+
+  def test_rescan_list_recognizes_move(self):
+    output = self.assert_syncer('.', 'list', '--rescan', '--format', 'tsv')
+    self.assertNotIn('missing', output)
+    self.assertIn('libA/src/sub/f1.h\t', output)
+
+
+class BudgetTest(SyncerTest):
+
+  def setUp(self):
+    super().setUp()
+    self.write('libA/old/w.h', 'int w;', home_repo='libA')
+    self.write('appB/vendor/x.h', 'int x;', home_repo='libA')
+    self.write('libA/src/x.h', 'int x;', home_repo='libA')
+    self.track_repos('libA', 'appB')
+    self.assert_syncer('.', 'check', '--all', '--report')
+
+  # The ranking is saved with the cache, newest first, with copy dirs ranked with their home dirs;
+  # appB/vendor is older than libA/old, but mirrors the newer libA/src.
+  def test_dir_ranking_is_saved(self):
+    with open(os.path.join(self.home, '.syncer', 'dir_recency')) as f:
+      lines = f.read().split('\n')
+    self.assertEqual(lines[1], '  3')
+    self.assertEqual(sorted(lines[2:4]), ['    ' + self.path('appB/vendor'),
+                                          '    ' + self.path('libA/src')])
+    self.assertEqual(lines[4:], ['    ' + self.path('libA/old'), ''])
+
+  def test_budgeted_check_finds_edit(self):
+    self.write('appB/vendor/x.h', 'int x, y;', home_repo='libA')
+    output = self.assert_syncer('.', 'check', '--all', '--report', '--budget', '100000', status=1)
+    self.assertIn(self.path('appB/vendor/x.h'), output)
+
+
+class FindDuplicatesTest(SyncerTest):
+
+  def setUp(self):
+    super().setUp()
+    for rel_path in ['libA/src/u.h', 'appB/vendor/u.h', 'appB/with space/u.h']:
+      self.write(rel_path, 'int u;')
+    for rel_path in ['libA/img.bin', 'appB/img.bin']:
+      with open(self.path(rel_path), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n\xff\xfe\xfd\n')
+    self.track_repos('libA', 'appB')
+
+  def test_untrackable_duplicates_are_not_suggested(self):
+    output = self.assert_syncer('.', 'find-duplicates')
+    track_lines = [line for line in output.split('\n') if line.startswith('syncer track')]
+    self.assertEqual(track_lines, ['syncer track %s %s' % (self.path('appB/vendor/u.h'),
+                                                           self.path('libA/src/u.h'))])
+    self.assertIn('#   %s\n' % self.path('appB/with space/u.h'), output)
+    self.assertIn('#   %s\n' % self.path('libA/img.bin'), output)
+    self.assert_syncer('.', *track_lines[0].split()[1:])
+    self.assert_syncer('.', 'list')
+    self.assert_syncer('.', 'check', '--all', '--report')
+
+
+class ScriptTest(SyncerTest):
+
+  def setUp(self):
+    super().setUp()
+    self.write('libA/src/x.h', 'int x;', home_repo='libA')
+    self.write('appB/vendor/x.h', 'int x, y;', home_repo='libA')
+    self.track_repos('libA', 'appB')
+
+  def test_report_runs_without_a_terminal(self):
+    status, output = self.run_script('.', 'check', '--all', '--report')
+    self.assertEqual(status, 1, output)
+    self.assertIn('Differences found', output)
+
+  def test_paths_from_stdin_run_without_a_terminal(self):
+    stdin_text = self.path('appB/vendor/x.h') + '\n'
+    status, output = self.run_script('.', 'check', '-', stdin_text=stdin_text)
+    self.assertEqual(status, 1, output)
+    self.assertIn('Differences found', output)
+
+  # No paths means nothing to check; the repos, which differ, mustn't be walked instead.
+  def test_empty_stdin_checks_nothing(self):
+    status, output = self.run_script('.', 'check', '-', stdin_text='')
+    self.assertEqual(status, 0, output)
+    self.assertIn('No differences found', output)
+
+
+if __name__ == '__main__':
+  unittest.main()